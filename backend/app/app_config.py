@@ -1,7 +1,9 @@
 import os
 from pathlib import Path
 
-from decouple import Config, RepositoryEnv  # type: ignore
+from decouple import Config, Csv, RepositoryEnv  # type: ignore
+
+from app.helpers import str_to_quantization_type
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -9,6 +11,18 @@ config = Config(RepositoryEnv(os.path.join(BASE_DIR, ".env")))
 
 APP_TITLE = str(config("APP_TITLE"))
 DATABASE_URL = str(config("DATABASE_URL"))
+# Read-only queries (similarity search, listings, counts) go round robin to the replicas, the primary serves them
+# when none is configured. Ingestion always writes to and dedups against the primary
+DATABASE_REPLICA_URLS: list[str] = config("DATABASE_REPLICA_URLS", default="", cast=Csv())
+# Per engine, the primary and every replica have a pool of their own
+DB_POOL_SIZE = int(config("DB_POOL_SIZE", default=5))
+DB_MAX_OVERFLOW = int(config("DB_MAX_OVERFLOW", default=10))
+DB_POOL_TIMEOUT = float(config("DB_POOL_TIMEOUT", default=30.0))
+# Seconds before a pooled connection is replaced, -1 keeps connections for good
+DB_POOL_RECYCLE = int(config("DB_POOL_RECYCLE", default=1800))
+DB_POOL_PRE_PING = config("DB_POOL_PRE_PING", default=True, cast=bool)
+# Prepared statements kept per asyncpg connection, 0 behind pgbouncer in transaction mode
+DB_STATEMENT_CACHE_SIZE = int(config("DB_STATEMENT_CACHE_SIZE", default=100))
 
 IMG_ORIG_DIR = Path(os.path.abspath(os.path.join(BASE_DIR, str(config("IMG_ORIG_DIR")))))
 IMG_TEMP_DIR = Path(os.path.abspath(os.path.join(BASE_DIR, str(config("IMG_TEMP_DIR")))))
@@ -27,6 +41,21 @@ IMG_ORIG_DIR_URL_PATH = "/source_img"
 MODEL_DEFAULT = "ArcFace"
 METRIC_DEFAULT = "cosine"
 DETECTOR_BACKEND = "mtcnn"
+MODEL_WARMUP = config("MODEL_WARMUP", default=True, cast=bool)
+INFERENCE_CONCURRENCY = int(config("INFERENCE_CONCURRENCY", default=2))
+INFERENCE_QUEUE_TIMEOUT = float(config("INFERENCE_QUEUE_TIMEOUT", default=10.0))
+INFERENCE_MAX_BATCH_SIZE = int(config("INFERENCE_MAX_BATCH_SIZE", default=16))
+INFERENCE_MAX_BATCH_WAIT_MS = float(config("INFERENCE_MAX_BATCH_WAIT_MS", default=10.0))
+# "local" runs the models in this process, "remote" sends images to the app.inference_server nodes,
+# unix:/path/to.sock URLs reach a sidecar node shared by all workers of this machine
+INFERENCE_BACKEND = str(config("INFERENCE_BACKEND", default="local"))
+INFERENCE_REMOTE_URLS: list[str] = config("INFERENCE_REMOTE_URLS", default="http://localhost:8002", cast=Csv())
+INFERENCE_REMOTE_TIMEOUT = float(config("INFERENCE_REMOTE_TIMEOUT", default=30.0))
+INFERENCE_REMOTE_RETRIES = int(config("INFERENCE_REMOTE_RETRIES", default=2))
+# Longer image side used for face detection, larger images are downscaled first, 0 disables it
+MAX_DETECTION_SIDE = int(config("MAX_DETECTION_SIDE", default=1920))
+UPLOAD_CACHE_SIZE = int(config("UPLOAD_CACHE_SIZE", default=256))
+UPLOAD_CACHE_TTL = float(config("UPLOAD_CACHE_TTL", default=600.0))
 
 MODEL_THRESHOLDS = {"Facenet": 0.8, "Facenet512": 0.5, "VGG-Face": 0.6, "ArcFace": 0.6}
 MODEL_VECTOR_SIZES = {
@@ -35,6 +64,52 @@ MODEL_VECTOR_SIZES = {
     "ArcFace": 512,
     "Facenet512": 512,
 }
+# HNSW build options and search defaults, ef_search is raised to the requested result count when lower
+HNSW_M = int(config("HNSW_M", default=16))
+HNSW_EF_CONSTRUCTION = int(config("HNSW_EF_CONSTRUCTION", default=64))
+HNSW_EF_SEARCH = int(config("HNSW_EF_SEARCH", default=40))
+# 0 keeps the server default
+IVFFLAT_PROBES = int(config("IVFFLAT_PROBES", default=0))
+# Filtered searches keep scanning the index until enough rows match, needs pgvector 0.8. Without it similarity
+# pages re-read the rows of the previous pages and end at the 1000 nearest faces
+VECTOR_ITERATIVE_SCAN = config("VECTOR_ITERATIVE_SCAN", default=True, cast=bool)
+VECTOR_INDEX_MAINTENANCE_WORK_MEM = str(config("VECTOR_INDEX_MAINTENANCE_WORK_MEM", default="1GB"))
+# Candidates are searched on compact codes first and re-ranked on the full vectors: none, halfvec, int8 or binary.
+# pgvector indexes halfvec and binary codes as expressions, int8 codes are kept by the mmap backend only
+VECTOR_QUANTIZATION = str_to_quantization_type(str(config("VECTOR_QUANTIZATION", default="none")))
+# Candidates re-ranked exactly per quantized or L2 search, never fewer than the requested results
+VECTOR_RERANK_DEPTH = int(config("VECTOR_RERANK_DEPTH", default=200))
+# "pgvector" searches in the database, "mmap" in memory-mapped matrices built by bin.vector_store and the feeder
+VECTOR_SEARCH_BACKEND = str(config("VECTOR_SEARCH_BACKEND", default="pgvector"))
+if VECTOR_SEARCH_BACKEND not in ("pgvector", "mmap"):
+    raise ValueError(f"{VECTOR_SEARCH_BACKEND} is not a valid vector search backend")
+if VECTOR_QUANTIZATION == "int8" and VECTOR_SEARCH_BACKEND == "pgvector":
+    # Checked at startup, every search would fail otherwise
+    raise ValueError(
+        "VECTOR_QUANTIZATION=int8 needs VECTOR_SEARCH_BACKEND=mmap, pgvector searches halfvec or binary codes"
+    )
+# Raw asyncpg connections of the exact pgvector similarity search, binary vectors and prepared statements.
+# 0 keeps every search on the SQLAlchemy session
+SEARCH_POOL_SIZE = int(config("SEARCH_POOL_SIZE", default=4))
+VECTOR_STORE_DIR = Path(
+    os.path.abspath(os.path.join(BASE_DIR, str(config("VECTOR_STORE_DIR", default="../static/vector_store"))))
+)
+FEEDER_MODELS: list[str] = config("FEEDER_MODELS", default=MODEL_DEFAULT, cast=Csv())
+FEEDER_WORKERS = int(config("FEEDER_WORKERS", default=os.cpu_count() or 1))
+FEEDER_QUEUE_SIZE = int(config("FEEDER_QUEUE_SIZE", default=64))
+FEEDER_BATCH_SIZE = int(config("FEEDER_BATCH_SIZE", default=500))
+FEEDER_FLUSH_SECONDS = float(config("FEEDER_FLUSH_SECONDS", default=5.0))
+FEEDER_PERCEPTUAL_DEDUP = config("FEEDER_PERCEPTUAL_DEDUP", default=False, cast=bool)
+FEEDER_REPORT_EVERY = 100
+
+# Results per page of the listing and similarity endpoints, pages continue from the cursor of the previous one
+PAGE_SIZE = int(config("PAGE_SIZE", default=50))
+MAX_PAGE_SIZE = int(config("MAX_PAGE_SIZE", default=200))
+# Shorter search terms have no trigram to look up in the index and would scan the whole table
+SEARCH_MIN_TERM_LENGTH = 3
+# Query faces of one batch similarity search
+MAX_BATCH_QUERIES = 50
+
 ALLOWED_ORIGINS = [
     "http://localhost:4200",
     "http://localhost:9000",
@@ -9,7 +9,11 @@ from app import (
     face_repository,
     face_service,
     image_feeder,
+    ingested_image_repository,
+    upload_cache,
     user_repository,
+    vector_index,
+    vector_store,
 )
 
 container = wireup.create_async_container(
@@ -17,6 +21,34 @@ container = wireup.create_async_container(
         "model_thresholds": cfg.MODEL_THRESHOLDS,
         "model_name": cfg.MODEL_DEFAULT,
         "detector_backend": cfg.DETECTOR_BACKEND,
+        "inference_concurrency": cfg.INFERENCE_CONCURRENCY,
+        "inference_queue_timeout": cfg.INFERENCE_QUEUE_TIMEOUT,
+        "inference_max_batch_size": cfg.INFERENCE_MAX_BATCH_SIZE,
+        "inference_max_batch_wait_ms": cfg.INFERENCE_MAX_BATCH_WAIT_MS,
+        "inference_backend": cfg.INFERENCE_BACKEND,
+        "inference_remote_urls": cfg.INFERENCE_REMOTE_URLS,
+        "inference_remote_timeout": cfg.INFERENCE_REMOTE_TIMEOUT,
+        "inference_remote_retries": cfg.INFERENCE_REMOTE_RETRIES,
+        "max_detection_side": cfg.MAX_DETECTION_SIDE,
+        "upload_cache_size": cfg.UPLOAD_CACHE_SIZE,
+        "upload_cache_ttl": cfg.UPLOAD_CACHE_TTL,
+        "hnsw_m": cfg.HNSW_M,
+        "hnsw_ef_construction": cfg.HNSW_EF_CONSTRUCTION,
+        "hnsw_ef_search": cfg.HNSW_EF_SEARCH,
+        "ivfflat_probes": cfg.IVFFLAT_PROBES,
+        "vector_iterative_scan": cfg.VECTOR_ITERATIVE_SCAN,
+        "vector_index_maintenance_work_mem": cfg.VECTOR_INDEX_MAINTENANCE_WORK_MEM,
+        "vector_quantization": cfg.VECTOR_QUANTIZATION,
+        "vector_rerank_depth": cfg.VECTOR_RERANK_DEPTH,
+        "vector_search_backend": cfg.VECTOR_SEARCH_BACKEND,
+        "vector_store_dir": cfg.VECTOR_STORE_DIR,
+        "search_pool_size": cfg.SEARCH_POOL_SIZE,
+        "feeder_models": cfg.FEEDER_MODELS,
+        "feeder_workers": cfg.FEEDER_WORKERS,
+        "feeder_queue_size": cfg.FEEDER_QUEUE_SIZE,
+        "feeder_batch_size": cfg.FEEDER_BATCH_SIZE,
+        "feeder_flush_seconds": cfg.FEEDER_FLUSH_SECONDS,
+        "feeder_perceptual_dedup": cfg.FEEDER_PERCEPTUAL_DEDUP,
     },
     service_modules=[
         face_repository,
@@ -24,8 +56,12 @@ container = wireup.create_async_container(
         dashboard_service,
         user_repository,
         image_feeder,
+        ingested_image_repository,
         auth_service,
         face_model_invoker,
+        upload_cache,
+        vector_index,
+        vector_store,
         db,
     ],
 )
@@ -1,14 +1,81 @@
-from collections.abc import AsyncGenerator
-from contextlib import asynccontextmanager
+import asyncio
+import itertools
+from collections.abc import AsyncGenerator, Mapping
+from contextlib import asynccontextmanager, suppress
+from typing import Annotated, Any
 
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+import asyncpg  # type: ignore
+from pgvector.asyncpg import register_vector  # type: ignore
+from pydantic import BaseModel, NonNegativeInt
+from sqlalchemy import URL, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import declarative_base
-from wireup import service
+from sqlalchemy.pool import QueuePool
+from wireup import Inject, service
 
-from app.app_config import DATABASE_URL
+from app.app_config import (
+    DATABASE_REPLICA_URLS,
+    DATABASE_URL,
+    DB_MAX_OVERFLOW,
+    DB_POOL_PRE_PING,
+    DB_POOL_RECYCLE,
+    DB_POOL_SIZE,
+    DB_POOL_TIMEOUT,
+    DB_STATEMENT_CACHE_SIZE,
+)
 
-engine = create_async_engine(DATABASE_URL, echo=False)
+ASYNCPG_DRIVER = "postgresql+asyncpg"
+
+
+class PoolStats(BaseModel):
+    name: str
+    connections: NonNegativeInt
+    in_use: NonNegativeInt
+    idle: NonNegativeInt
+    max_connections: NonNegativeInt
+
+
+class ReadSession(AsyncSession):
+    # Session of the read replicas, they lag behind the primary. Nothing that must see its own writes uses it
+    pass
+
+
+def create_engine(url: str) -> AsyncEngine:
+    connect_args: dict[str, Any] = {}
+    if make_url(url).drivername == ASYNCPG_DRIVER:
+        # SQLAlchemy prepares its statements itself, asyncpg caches those of its own fetch calls
+        connect_args = {
+            "prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+            "statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+        }
+    return create_async_engine(
+        url,
+        echo=False,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        connect_args=connect_args,
+    )
+
+
+def pool_name(url: URL, role: str) -> str:
+    return f"{role} {url.host or 'localhost'}/{url.database or ''}"
+
+
+engine = create_engine(DATABASE_URL)
+replica_engines = [create_engine(url) for url in DATABASE_REPLICA_URLS]
 async_session_factory = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+# Read-only transactions, a misrouted write fails instead of landing on the primary by accident
+_read_session_factories = itertools.cycle(
+    [
+        async_sessionmaker(
+            read_engine.execution_options(postgresql_readonly=True), class_=ReadSession, expire_on_commit=False
+        )
+        for read_engine in replica_engines or [engine]
+    ]
+)
 
 Base = declarative_base()
 
@@ -18,3 +85,117 @@ Base = declarative_base()
 async def get_session() -> AsyncGenerator[AsyncSession]:
     async with async_session_factory() as session:
         yield session
+
+
+@asynccontextmanager
+@service(lifetime="scoped")
+async def get_read_session() -> AsyncGenerator[ReadSession]:
+    # Connects on first use only, scopes that never read pay nothing for it
+    async with read_session() as session:
+        yield session
+
+
+def read_session() -> ReadSession:
+    return next(_read_session_factories)()
+
+
+def pool_stats() -> list[PoolStats]:
+    stats = []
+    for role, pool_engine in [("primary", engine), *(("replica", replica) for replica in replica_engines)]:
+        pool = pool_engine.pool
+        if isinstance(pool, QueuePool):
+            stats.append(
+                PoolStats(
+                    name=pool_name(pool_engine.url, role),
+                    connections=pool.checkedin() + pool.checkedout(),
+                    in_use=pool.checkedout(),
+                    idle=pool.checkedin(),
+                    max_connections=pool.size() + DB_MAX_OVERFLOW,
+                )
+            )
+    return stats
+
+
+async def is_asyncpg_session(session: AsyncSession) -> bool:
+    conn = await session.connection()
+    return conn.dialect.driver == "asyncpg"
+
+
+@asynccontextmanager
+async def asyncpg_connection(session: AsyncSession) -> AsyncGenerator[asyncpg.Connection]:
+    # The ORM binds vectors as text, binary codecs must not outlive this block on the pooled connection
+    conn = await session.connection()
+    raw = await conn.get_raw_connection()
+    driver_conn = raw.driver_connection
+    if driver_conn is None:
+        raise RuntimeError("Session connection has no asyncpg driver connection")
+    await register_vector(driver_conn)
+    try:
+        yield driver_conn
+    finally:
+        for type_name in ("vector", "halfvec", "sparsevec"):
+            with suppress(ValueError):
+                await driver_conn.reset_type_codec(type_name, schema="public")
+
+
+# One round trip for all transaction-local search settings
+SET_CONFIG_SQL = "SELECT set_config(name, value, true) FROM unnest($1::text[], $2::text[]) AS s(name, value)"
+
+
+@service(lifetime="singleton")
+class SearchPool:
+    # Connections of its own, pgvector's binary codecs stay registered on them for good: query vectors go out as
+    # float32 buffers and asyncpg keeps each statement prepared per connection. Setting or resetting a codec on a
+    # session connection costs round trips and drops its prepared statements, on every search
+    # Searches are reads, a pool per replica taken round robin like the read sessions
+    def __init__(self, size: Annotated[int, Inject(param="search_pool_size")]):
+        urls = [make_url(url) for url in DATABASE_REPLICA_URLS or [DATABASE_URL]]
+        self._size = size if all(url.drivername == ASYNCPG_DRIVER for url in urls) else 0
+        self._urls = urls
+        self._role = "search replica" if DATABASE_REPLICA_URLS else "search primary"
+        self._pools: list[asyncpg.Pool | None] = [None] * len(urls)
+        self._next = itertools.cycle(range(len(urls)))
+        self._lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self._size > 0
+
+    async def fetch(self, settings: Mapping[str, str], query: str, *args: Any) -> list[asyncpg.Record]:
+        pool = await self._get_pool(next(self._next))
+        async with pool.acquire() as conn, conn.transaction(readonly=True):
+            if settings:
+                await conn.execute(SET_CONFIG_SQL, list(settings), list(settings.values()))
+            return await conn.fetch(query, *args)
+
+    def stats(self) -> list[PoolStats]:
+        return [
+            PoolStats(
+                name=pool_name(url, self._role),
+                connections=pool.get_size(),
+                in_use=pool.get_size() - pool.get_idle_size(),
+                idle=pool.get_idle_size(),
+                max_connections=pool.get_max_size(),
+            )
+            for url, pool in zip(self._urls, self._pools, strict=True)
+            if pool is not None
+        ]
+
+    async def aclose(self) -> None:
+        for i, pool in enumerate(self._pools):
+            if pool is not None:
+                await pool.close()
+                self._pools[i] = None
+
+    async def _get_pool(self, i: int) -> asyncpg.Pool:
+        if self._pools[i] is None:
+            async with self._lock:
+                if self._pools[i] is None:
+                    self._pools[i] = await asyncpg.create_pool(
+                        self._urls[i].set(drivername="postgresql").render_as_string(hide_password=False),
+                        min_size=1,
+                        max_size=self._size,
+                        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+                        init=register_vector,
+                    )
+        return self._pools[i]
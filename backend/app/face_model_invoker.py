@@ -1,12 +1,30 @@
+import asyncio
+import io
 import mimetypes
+import os
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Annotated, override
+from collections.abc import AsyncGenerator, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Annotated, Any, override
 
 import httpx
-from deepface import DeepFace  # type: ignore
+import numpy as np
+from PIL import Image
 from pydantic import BaseModel, Field, NonNegativeFloat, NonNegativeInt
 from wireup import Inject, abstract, service
 
+from app.image_processor import downscale_image, load_image
+
+WARMUP_IMAGE_SIZE = 224
+UNIX_SOCKET_PREFIX = "unix:"
+NO_FACE_ERROR = "no_face"
+
+# File path, encoded image bytes or an already decoded BGR array
+ImageInput = str | bytes | np.ndarray
+
 
 class FacialArea(BaseModel):
     x: NonNegativeInt
@@ -37,59 +55,518 @@ class FaceEmbeddingList(BaseModel):
 @abstract
 class FaceModelInterface(ABC):
     @abstractmethod
-    def represent_face(self, img_path: str) -> FaceEmbeddingList: ...
+    def represent_face(self, img: ImageInput) -> FaceEmbeddingList: ...
+
+
+class InferenceStats(BaseModel):
+    concurrency: NonNegativeInt
+    running: NonNegativeInt
+    waiting: NonNegativeInt
+    completed: NonNegativeInt
+    rejected: NonNegativeInt
+    avg_queue_ms: NonNegativeFloat
+    max_queue_ms: NonNegativeFloat
+    batch_count: NonNegativeInt
+    batched_faces: NonNegativeInt
+
+
+class AsyncFaceModelInterface(ABC):
+    @abstractmethod
+    async def represent_face(self, img: ImageInput) -> FaceEmbeddingList: ...
+
+    @abstractmethod
+    def stats(self) -> InferenceStats: ...
+
+    @property
+    @abstractmethod
+    def ready(self) -> bool: ...
 
 
 class NoFaceFound(Exception):
     pass
 
 
-class RemoteFaceModel(FaceModelInterface):
+class InferenceOverloaded(Exception):
+    pass
+
+
+class RemoteFaceResult(BaseModel):
+    faces: list[FaceEmbedding] = []
+    error: str | None = None
+
+    def to_embedding_list(self) -> FaceEmbeddingList:
+        if self.error == NO_FACE_ERROR:
+            raise NoFaceFound("Face could not be detected")
+        if self.error is not None:
+            raise ValueError(self.error)
+        return FaceEmbeddingList(faces=self.faces)
+
+
+class RemoteBatchResponse(BaseModel):
+    results: list[RemoteFaceResult]
+
+
+class InferenceSlots:
+    # Bounded concurrency with a queue budget, callers waiting longer are rejected instead of piling up
+    def __init__(self, concurrency: int, queue_timeout: float):
+        self.concurrency = max(1, concurrency)
+        self._queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._running = 0
+        self._waiting = 0
+        self._completed = 0
+        self._rejected = 0
+        self._queue_seconds_total = 0.0
+        self._queue_seconds_max = 0.0
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncGenerator[None]:
+        queued_at = time.monotonic()
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self._queue_timeout)
+        except TimeoutError:
+            self._rejected += 1
+            raise InferenceOverloaded(f"Inference queue wait exceeded {self._queue_timeout}s")
+        finally:
+            self._waiting -= 1
+
+        queue_seconds = time.monotonic() - queued_at
+        self._queue_seconds_total += queue_seconds
+        self._queue_seconds_max = max(self._queue_seconds_max, queue_seconds)
+
+        self._running += 1
+        try:
+            yield
+        finally:
+            self._running -= 1
+            self._completed += 1
+            self._semaphore.release()
+
+    def stats(self, batch_count: int, batched_faces: int) -> InferenceStats:
+        started = self._completed + self._running
+        return InferenceStats(
+            concurrency=self.concurrency,
+            running=self._running,
+            waiting=self._waiting,
+            completed=self._completed,
+            rejected=self._rejected,
+            avg_queue_ms=self._queue_seconds_total / started * 1000 if started else 0.0,
+            max_queue_ms=self._queue_seconds_max * 1000,
+            batch_count=batch_count,
+            batched_faces=batched_faces,
+        )
+
+
+# DeepFace and TensorFlow are imported on first use, processes that only talk to an inference node never load them
+@service(lifetime="singleton")
+class FaceModelRegistry:
+    def __init__(self, detector_backend: Annotated[str, Inject(param="detector_backend")]):
+        self._detector_backend = detector_backend
+        self._models: dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._warming_up = False
+
+    @property
+    def detector_backend(self) -> str:
+        return self._detector_backend
+
+    @property
+    def ready(self) -> bool:
+        # Not ready only while a warm-up runs. Without one, or after a failed one, models load on first use
+        return not self._warming_up
+
+    def start_warm_up(self, model_names: Sequence[str]) -> asyncio.Task[None]:
+        self._warming_up = True
+        task = asyncio.create_task(asyncio.to_thread(self.warm_up, model_names))
+        task.add_done_callback(self._warm_up_done)
+        return task
+
+    def _warm_up_done(self, task: asyncio.Task[None]) -> None:
+        self._warming_up = False
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Face model warm-up failed, models are loaded on first use instead: {task.exception()!r}")
+
+    def get_model(self, model_name: str) -> Any:
+        model = self._models.get(model_name)
+        if model is None:
+            with self._lock:
+                model = self._models.get(model_name)
+                if model is None:
+                    from deepface import DeepFace  # type: ignore
+
+                    model = DeepFace.build_model(model_name=model_name, task="facial_recognition")
+                    self._models[model_name] = model
+        return model
+
+    def warm_up(self, model_names: Sequence[str]) -> None:
+        # Loads the weights and runs one dummy inference, so the first real request doesn't pay for graph tracing
+        from deepface import DeepFace  # type: ignore
+
+        started_at = time.monotonic()
+        blank = np.zeros((WARMUP_IMAGE_SIZE, WARMUP_IMAGE_SIZE, 3), dtype=np.uint8)
+
+        DeepFace.build_model(model_name=self._detector_backend, task="face_detector")
+        DeepFace.extract_faces(img_path=blank, detector_backend=self._detector_backend, enforce_detection=False)
+        for model_name in model_names:
+            self.embed([blank.astype(np.float32)], model_name)
+
+        print(f"Face models ready in {time.monotonic() - started_at:.1f}s: {self._detector_backend}, {model_names}")
+
+    def embed(self, crops: list[np.ndarray], model_name: str) -> list[list[float]]:
+        # Same preprocessing as DeepFace.represent, crops come from extract_faces as RGB in [0, 1]
+        from deepface.modules import preprocessing  # type: ignore
+
+        model = self.get_model(model_name)
+        target_size = model.input_shape
+        batch = np.concatenate(
+            [
+                preprocessing.normalize_input(
+                    img=preprocessing.resize_image(img=crop[:, :, ::-1], target_size=(target_size[1], target_size[0])),
+                    normalization="base",
+                )
+                for crop in crops
+            ],
+            axis=0,
+        )
+        embeddings = model.forward(batch)
+        return [embeddings] if len(crops) == 1 else embeddings
+
+
+@service(lifetime="singleton")
+class LocalFaceModel(FaceModelInterface):
     def __init__(
         self,
-        detector_backend: Annotated[str, Inject(param="detector_backend")],
+        registry: FaceModelRegistry,
         model_name: Annotated[str, Inject(param="model_name")],
+        max_detection_side: Annotated[int, Inject(param="max_detection_side")],
     ):
-        self._detector_backend = detector_backend
+        self._registry = registry
         self._model_name = model_name
+        self._max_detection_side = max_detection_side
 
     @override
-    def represent_face(self, img_path: str) -> FaceEmbeddingList:
-        """TODO"""
-        url = "http://localhost:8002/api/represent"
-        form_data = {
-            "detector_backend": self._detector_backend,
-            "model_name": self._model_name,
+    def represent_face(self, img: ImageInput) -> FaceEmbeddingList:
+        return self.represent_face_multi(img, [self._model_name])[self._model_name]
+
+    @property
+    def model_name(self) -> str:
+        return self._model_name
+
+    def represent_face_multi(self, img: ImageInput, model_names: Sequence[str]) -> dict[str, FaceEmbeddingList]:
+        # Detection and alignment run once, the same crops are embedded by every model
+        detected = self.detect_faces(img)
+        crops = [face["face"] for face in detected]
+        return {
+            model_name: self.to_embedding_list(detected, self._registry.embed(crops, model_name))
+            for model_name in model_names
         }
-        with open(img_path, "rb") as image_file:
-            mime_type, _ = mimetypes.guess_type(img_path)
-            files = {"file": (img_path, image_file, mime_type or "application/octet-stream")}
-            resp = httpx.post(url, data=form_data, files=files)
-            data = FaceEmbeddingList.model_validate({"faces": resp.json()})
-            return data
 
+    def detect_faces(self, img: ImageInput) -> list[dict[str, Any]]:
+        # Images are decoded once in memory and shrunk before detection, boxes are reported in original pixels
+        if isinstance(img, np.ndarray):
+            pixels, scale = downscale_image(img, self._max_detection_side)
+        else:
+            pixels, scale = load_image(img, self._max_detection_side)
 
-@service(lifetime="scoped")
-class LocalFaceModel(FaceModelInterface):
+        from deepface import DeepFace  # type: ignore
+
+        try:
+            detected = DeepFace.extract_faces(img_path=pixels, detector_backend=self._registry.detector_backend)
+        except ValueError as e:
+            if e.args and str(e.args[0]).startswith("Face could not be detected"):
+                raise NoFaceFound(str(e.args[0]))
+            raise e
+
+        if not detected:
+            raise NoFaceFound("Face could not be detected")
+
+        if scale != 1.0:
+            for face in detected:
+                face["facial_area"] = self._to_original_scale(face["facial_area"], scale)
+        return detected
+
+    @staticmethod
+    def _to_original_scale(area: dict[str, Any], scale: float) -> dict[str, Any]:
+        scaled: dict[str, Any] = {}
+        for key, value in area.items():
+            if isinstance(value, int | float):
+                scaled[key] = round(value / scale)
+            elif isinstance(value, tuple | list):
+                scaled[key] = tuple(round(v / scale) for v in value)
+            else:
+                scaled[key] = value
+        return scaled
+
+    @staticmethod
+    def to_embedding_list(detected: list[dict[str, Any]], embeddings: list[list[float]]) -> FaceEmbeddingList:
+        return FaceEmbeddingList.model_validate(
+            {
+                "faces": [
+                    {"embedding": emb, "facial_area": face["facial_area"], "face_confidence": face["confidence"]}
+                    for face, emb in zip(detected, embeddings, strict=True)
+                ]
+            }
+        )
+
+
+BatchItem = tuple[list[np.ndarray], asyncio.Future[list[list[float]]]]
+
+
+class EmbeddingBatcher:
+    def __init__(self, registry: FaceModelRegistry, model_name: str, max_batch_size: int, max_wait: float):
+        self._registry = registry
+        self._model_name = model_name
+        self._max_batch_size = max(1, max_batch_size)
+        self._max_wait = max_wait
+        # One forward pass at a time, TensorFlow already spreads a batch over all cores
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding-batch")
+        self._queue: asyncio.Queue[BatchItem] | None = None
+        self._worker: asyncio.Task[None] | None = None
+        self._carry: BatchItem | None = None
+        self.batch_count = 0
+        self.crop_count = 0
+
+    async def embed(self, crops: list[np.ndarray]) -> list[list[float]]:
+        if not crops:
+            return []
+
+        if self._queue is None or self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run(self._queue))
+
+        future: asyncio.Future[list[list[float]]] = asyncio.get_running_loop().create_future()
+        await self._queue.put((crops, future))
+        return await future
+
+    async def _run(self, queue: asyncio.Queue[BatchItem]) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._next(queue)]
+            size = len(batch[0][0])
+            deadline = loop.time() + self._max_wait
+
+            # Collect crops of concurrent requests until the batch is full or the window closes
+            while size < self._max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=timeout)
+                except TimeoutError:
+                    break
+                if size + len(item[0]) > self._max_batch_size:
+                    self._carry = item
+                    break
+                batch.append(item)
+                size += len(item[0])
+
+            crops = [crop for item_crops, _ in batch for crop in item_crops]
+            try:
+                embeddings = await loop.run_in_executor(self._executor, self._registry.embed, crops, self._model_name)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batch_count += 1
+            self.crop_count += len(crops)
+
+            offset = 0
+            for item_crops, future in batch:
+                if not future.done():
+                    future.set_result(embeddings[offset : offset + len(item_crops)])
+                offset += len(item_crops)
+
+    async def _next(self, queue: asyncio.Queue[BatchItem]) -> BatchItem:
+        if self._carry is not None:
+            item, self._carry = self._carry, None
+            return item
+        return await queue.get()
+
+
+@service(lifetime="singleton")
+class ExecutorFaceModel(AsyncFaceModelInterface):
     def __init__(
         self,
+        face_engine: FaceModelInterface,
+        registry: FaceModelRegistry,
+        concurrency: Annotated[int, Inject(param="inference_concurrency")],
+        queue_timeout: Annotated[float, Inject(param="inference_queue_timeout")],
+        max_batch_size: Annotated[int, Inject(param="inference_max_batch_size")],
+        max_batch_wait_ms: Annotated[float, Inject(param="inference_max_batch_wait_ms")],
+    ):
+        self._face_engine = face_engine
+        self._registry = registry
+        self._batcher: EmbeddingBatcher | None = None
+        if max_batch_size > 1 and isinstance(face_engine, LocalFaceModel):
+            self._batcher = EmbeddingBatcher(registry, face_engine.model_name, max_batch_size, max_batch_wait_ms / 1000)
+        self._slots = InferenceSlots(concurrency, queue_timeout)
+        self._executor = ThreadPoolExecutor(max_workers=self._slots.concurrency, thread_name_prefix="inference")
+
+    @override
+    async def represent_face(self, img: ImageInput) -> FaceEmbeddingList:
+        # Inference runs off the event loop, callers over the queue budget are rejected instead of piling up
+        async with self._slots.acquire():
+            loop = asyncio.get_running_loop()
+            if self._batcher is None or not isinstance(self._face_engine, LocalFaceModel):
+                return await loop.run_in_executor(self._executor, self._face_engine.represent_face, img)
+
+            # Only detection holds a slot, embedding is batched together with other requests
+            detected = await loop.run_in_executor(self._executor, self._face_engine.detect_faces, img)
+
+        embeddings = await self._batcher.embed([face["face"] for face in detected])
+        return self._face_engine.to_embedding_list(detected, embeddings)
+
+    @override
+    def stats(self) -> InferenceStats:
+        return self._slots.stats(
+            batch_count=self._batcher.batch_count if self._batcher else 0,
+            batched_faces=self._batcher.crop_count if self._batcher else 0,
+        )
+
+    @property
+    @override
+    def ready(self) -> bool:
+        return self._registry.ready
+
+
+@service(lifetime="singleton")
+class RemoteFaceModel(AsyncFaceModelInterface):
+    def __init__(
+        self,
+        endpoints: Annotated[list[str], Inject(param="inference_remote_urls")],
         detector_backend: Annotated[str, Inject(param="detector_backend")],
         model_name: Annotated[str, Inject(param="model_name")],
+        concurrency: Annotated[int, Inject(param="inference_concurrency")],
+        queue_timeout: Annotated[float, Inject(param="inference_queue_timeout")],
+        max_batch_size: Annotated[int, Inject(param="inference_max_batch_size")],
+        request_timeout: Annotated[float, Inject(param="inference_remote_timeout")],
+        retries: Annotated[int, Inject(param="inference_remote_retries")],
     ):
+        self._endpoints: list[str] = []
+        # unix:/path/to.sock endpoints reach an inference sidecar on this machine without TCP
+        self._socket_paths: dict[str, str] = {}
+        for url in endpoints:
+            if url.startswith(UNIX_SOCKET_PREFIX):
+                base_url = f"http://inference-socket-{len(self._socket_paths)}"
+                self._socket_paths[base_url] = url.removeprefix(UNIX_SOCKET_PREFIX)
+                self._endpoints.append(base_url)
+            elif url:
+                self._endpoints.append(url.rstrip("/"))
         self._detector_backend = detector_backend
         self._model_name = model_name
+        self._max_batch_size = max(1, max_batch_size)
+        self._request_timeout = request_timeout
+        self._retries = max(0, retries)
+        # Every node gets the same number of in-flight requests as a local executor would run
+        self._slots = InferenceSlots(concurrency * max(1, len(self._endpoints)), queue_timeout)
+        self._client: httpx.AsyncClient | None = None
+        self._next_endpoint = 0
+        self._batch_count = 0
+        self._image_count = 0
 
     @override
-    def represent_face(self, img_path: str) -> FaceEmbeddingList:
-        try:
-            data = DeepFace.represent(
-                img_path=img_path,
-                model_name=self._model_name,
-                detector_backend=self._detector_backend,
+    async def represent_face(self, img: ImageInput) -> FaceEmbeddingList:
+        (result,) = await self.represent_faces([img])
+        return result.to_embedding_list()
+
+    async def represent_faces(self, images: Sequence[ImageInput]) -> list[RemoteFaceResult]:
+        chunks = [images[i : i + self._max_batch_size] for i in range(0, len(images), self._max_batch_size)]
+        results = await asyncio.gather(*(self._post_batch(chunk) for chunk in chunks))
+        return [result for chunk_results in results for result in chunk_results]
+
+    @override
+    def stats(self) -> InferenceStats:
+        return self._slots.stats(batch_count=self._batch_count, batched_faces=self._image_count)
+
+    @property
+    @override
+    def ready(self) -> bool:
+        return bool(self._endpoints)
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _post_batch(self, images: Sequence[ImageInput]) -> list[RemoteFaceResult]:
+        if not self._endpoints:
+            raise InferenceOverloaded("No remote inference endpoint is configured")
+
+        files = [("files", await asyncio.to_thread(self._to_upload, img)) for img in images]
+        form_data = {"detector_backend": self._detector_backend, "model_name": self._model_name}
+        last_error: Exception | None = None
+
+        async with self._slots.acquire():
+            for _ in range(self._retries + 1):
+                endpoint = self._pick_endpoint()
+                try:
+                    resp = await self._get_client().post(f"{endpoint}/api/represent-batch", data=form_data, files=files)
+                except httpx.TransportError as e:
+                    last_error = e
+                    continue
+
+                if resp.status_code == 503:
+                    # The node is saturated, the next one may have room
+                    last_error = InferenceOverloaded(f"Inference node {endpoint} is overloaded")
+                    continue
+
+                resp.raise_for_status()
+                results = RemoteBatchResponse.model_validate(resp.json()).results
+                if len(results) != len(images):
+                    raise ValueError(f"Inference node {endpoint} returned {len(results)} results for {len(images)}")
+
+                self._batch_count += 1
+                self._image_count += len(images)
+                return results
+
+        if isinstance(last_error, InferenceOverloaded):
+            raise last_error
+        raise InferenceOverloaded(f"No inference node is reachable: {last_error}") from last_error
+
+    def _pick_endpoint(self) -> str:
+        endpoint = self._endpoints[self._next_endpoint % len(self._endpoints)]
+        self._next_endpoint += 1
+        return endpoint
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # One pooled client for all requests, connections to every node are kept alive
+        if self._client is None:
+            limits = httpx.Limits(
+                max_connections=self._slots.concurrency, max_keepalive_connections=self._slots.concurrency
             )
-            validated = FaceEmbeddingList.model_validate({"faces": data})
-            return validated
-        except ValueError as e:
-            if e.args and str(e.args[0]).startswith("Face could not be detected"):
-                raise NoFaceFound(str(e.args[0]))
-            raise e
+            self._client = httpx.AsyncClient(
+                timeout=self._request_timeout,
+                limits=limits,
+                mounts={
+                    base_url: httpx.AsyncHTTPTransport(uds=socket_path, limits=limits)
+                    for base_url, socket_path in self._socket_paths.items()
+                },
+            )
+        return self._client
+
+    @staticmethod
+    def _to_upload(img: ImageInput) -> tuple[str, bytes, str]:
+        if isinstance(img, str):
+            mime_type, _ = mimetypes.guess_type(img)
+            with open(img, "rb") as image_file:
+                return os.path.basename(img), image_file.read(), mime_type or "application/octet-stream"
+        if isinstance(img, bytes):
+            return "upload", img, "application/octet-stream"
+
+        # Decoded arrays are sent losslessly
+        buffer = io.BytesIO()
+        Image.fromarray(np.ascontiguousarray(img[:, :, ::-1])).save(buffer, format="PNG")
+        return "upload.png", buffer.getvalue(), "image/png"
+
+
+@service(lifetime="singleton")
+def create_face_engine(
+    backend: Annotated[str, Inject(param="inference_backend")],
+    local: ExecutorFaceModel,
+    remote: RemoteFaceModel,
+) -> AsyncFaceModelInterface:
+    # Inference runs in this process or on remote nodes serving app.inference_server
+    return remote if backend == "remote" else local
@@ -1,22 +1,39 @@
 from datetime import UTC, datetime
+from typing import Any
 
 import numpy as np
 from pgvector.sqlalchemy import Vector  # type: ignore
-from sqlalchemy import JSON, DateTime, Float, Integer, String
+from sqlalchemy import JSON, DateTime, Float, Index, Integer, String, func
 from sqlalchemy.orm import Mapped, mapped_column
 
 from app.app_config import MODEL_VECTOR_SIZES
 from app.db import Base
+from app.helpers import normalize
+
+EMBEDDING_GROUP = "embedding"
+EMBEDDING_LOADING: dict[str, Any] = {"deferred": True, "deferred_group": EMBEDDING_GROUP, "deferred_raiseload": True}
 
 
 class FaceRegion(Base):
     __tablename__ = "face_region"
+    __table_args__ = (
+        # Substring search of /list, a trigram index also serves ILIKE patterns with a leading wildcard
+        Index(
+            "ix_face_region_filename_trgm",
+            "filename",
+            postgresql_using="gin",
+            postgresql_ops={"filename": "gin_trgm_ops"},
+        ),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     filename: Mapped[str] = mapped_column(String(250), nullable=False)
-    emb_128: Mapped[np.ndarray | None] = mapped_column(Vector(128), nullable=True)
-    emb_512: Mapped[np.ndarray | None] = mapped_column(Vector(512), nullable=True)
-    emb_4096: Mapped[np.ndarray | None] = mapped_column(Vector(4096), nullable=True)
+    # Loaded on demand only, with undefer_group("embedding"). Touching them unloaded raises instead of lazy loading
+    emb_128: Mapped[np.ndarray | None] = mapped_column(Vector(128), nullable=True, **EMBEDDING_LOADING)
+    emb_512: Mapped[np.ndarray | None] = mapped_column(Vector(512), nullable=True, **EMBEDDING_LOADING)
+    emb_4096: Mapped[np.ndarray | None] = mapped_column(Vector(4096), nullable=True, **EMBEDDING_LOADING)
+    # Embeddings are stored L2-normalized, the original length keeps L2 distances computable
+    emb_norm: Mapped[float | None] = mapped_column(Float, nullable=True)
     x: Mapped[int] = mapped_column(Integer)
     y: Mapped[int] = mapped_column(Integer)
     w: Mapped[int] = mapped_column(Integer)
@@ -31,6 +48,8 @@ class FaceRegion(Base):
         nullable=False,
     )
     model: Mapped[str] = mapped_column(String(25), nullable=False)
+    # Uniform random key set by the database, random samples are index range scans from a random point
+    sample_key: Mapped[float | None] = mapped_column(Float, server_default=func.random(), index=True)
 
     def __init__(
         self,
@@ -75,6 +94,8 @@ class FaceRegion(Base):
         self.emb_512 = None
         self.emb_128 = None
         self.emb_4096 = None
+        self.emb_norm = float(np.linalg.norm(vector))
+        vector = normalize(vector).astype(np.float32)
 
         if model == "VGG-Face":
             self.emb_4096 = vector
@@ -93,10 +114,13 @@ class FaceRegion(Base):
 
         model = self.model
         if model == "VGG-Face":
-            return type_ok(self.emb_4096)
+            vector = type_ok(self.emb_4096)
         elif model == "Facenet":
-            return type_ok(self.emb_128)
+            vector = type_ok(self.emb_128)
         elif model == "ArcFace" or model == "Facenet512":
-            return type_ok(self.emb_512)
+            vector = type_ok(self.emb_512)
         else:
             raise Exception(f"Model '{model}' not implemented yet")
+
+        # Back to the scale the model produced, rows not migrated yet are stored that way already
+        return vector * self.emb_norm if self.emb_norm is not None else vector
@@ -0,0 +1,86 @@
+import time
+from collections.abc import Iterable
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.face_region import FaceRegion
+from app.face_repository import FaceRepository
+from app.ingested_image import ImageRecord
+from app.ingested_image_repository import IngestedImageRepository
+
+
+class FaceRegionBatchWriter:
+    def __init__(
+        self,
+        session: AsyncSession,
+        face_repository: FaceRepository,
+        image_repository: IngestedImageRepository,
+        batch_size: int,
+        flush_seconds: float,
+    ):
+        self._session = session
+        self._face_repo = face_repository
+        self._image_repo = image_repository
+        self._batch_size = max(1, batch_size)
+        self._flush_seconds = flush_seconds
+        self._rows: list[FaceRegion] = []
+        self._images: dict[str, ImageRecord] = {}
+        self._replaced_filenames: set[str] = set()
+        self._aliases: list[tuple[str, str]] = []
+        self._first_row_at: float | None = None
+        self.written_count = 0
+        # Ids per model of the rows replaced by the last flush
+        self.deleted_ids: dict[str, list[int]] = {}
+
+    def add(
+        self,
+        image: ImageRecord,
+        faces: Iterable[FaceRegion] = (),
+        replace: bool = False,
+        alias_of: str | None = None,
+    ) -> None:
+        self._rows.extend(faces)
+        self._images[image.path] = image
+        if replace:
+            self._replaced_filenames.add(image.path)
+        if alias_of is not None:
+            self._aliases.append((alias_of, image.path))
+        if self._first_row_at is None:
+            self._first_row_at = time.monotonic()
+
+    def should_flush(self) -> bool:
+        return len(self._rows) + len(self._images) >= self._batch_size or self.seconds_until_flush() == 0.0
+
+    def seconds_until_flush(self) -> float | None:
+        if self._first_row_at is None:
+            return None
+        return max(0.0, self._first_row_at + self._flush_seconds - time.monotonic())
+
+    async def flush(self) -> int:
+        if not self._rows and not self._images:
+            return 0
+
+        rows = self._rows
+        images = list(self._images.values())
+        replaced = list(self._replaced_filenames)
+        aliases = self._aliases
+        self._rows = []
+        self._images = {}
+        self._replaced_filenames = set()
+        self._aliases = []
+        self._first_row_at = None
+
+        # Face rows and the manifest are committed together, so a crash never records an image without its faces
+        deleted = await self._face_repo.delete_by_filenames(replaced)
+        count = await self._face_repo.bulk_insert(rows)
+        # Duplicates copy the rows of their source, which is either committed already or inserted just above
+        for source, target in aliases:
+            count += await self._face_repo.copy_faces(source, target)
+        await self._image_repo.upsert(images)
+        await self._session.commit()
+
+        self.deleted_ids = {}
+        for face_id, model in deleted:
+            self.deleted_ids.setdefault(model, []).append(face_id)
+        self.written_count += count
+        return count
@@ -1,60 +1,202 @@
 import datetime
+import json
+import random
 import re
 from collections.abc import Sequence
+from typing import Annotated, Any, NamedTuple
 
 import numpy as np
-from pgvector.sqlalchemy import VECTOR  # type: ignore
-from sqlalchemy import cast, func, or_
+from pgvector.sqlalchemy import BIT, HALFVEC, VECTOR  # type: ignore
+from sqlalchemy import Float, Select, and_, cast, delete, func, insert, literal, or_, true, union_all
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from wireup import service
+from sqlalchemy.orm import InstrumentedAttribute, aliased, undefer_group
+from sqlalchemy.orm.util import AliasedClass
+from sqlalchemy.sql.elements import ColumnElement
+from wireup import Inject, service
 
-from app.face_region import FaceRegion
-from app.helpers import MetricType, ModelType
+from app.app_config import MODEL_VECTOR_SIZES, SEARCH_MIN_TERM_LENGTH
+from app.db import ReadSession, SearchPool, asyncpg_connection, is_asyncpg_session
+from app.face_region import EMBEDDING_GROUP, FaceRegion
+from app.helpers import MetricType, ModelType, normalize, str_to_quantization_type
+from app.pagination import InvalidCursor
+
+BULK_INSERT_COLUMNS = (
+    "filename",
+    "emb_128",
+    "emb_512",
+    "emb_4096",
+    "emb_norm",
+    "x",
+    "y",
+    "w",
+    "h",
+    "left_eye",
+    "right_eye",
+    "face_confidence",
+    "face_quality",
+    "created_at",
+    "model",
+)
+JSON_COLUMNS = ("left_eye", "right_eye")
+# Extra nearest rows fetched per page for the id tie-break. Only identical embeddings tie, a run of more equal
+# distances than this can lose rows at a page boundary
+KEYSET_TIE_MARGIN = 16
+# Upper bound of hnsw.ef_search
+HNSW_MAX_EF_SEARCH = 1000
+
+
+class FaceRow(NamedTuple):
+    # Columns read by the list, detail and search results, a fraction of the row without the embeddings
+    id: int
+    filename: str
+    model: str
+    x: int
+    y: int
+    w: int
+    h: int
+    face_confidence: float
+    face_quality: float
+
+
+class SimilarFace(NamedTuple):
+    face: FaceRow
+    distance: float
+    # Value the rows are ordered by, pages continue after (sort_key, id)
+    sort_key: float
 
 
 @service(lifetime="scoped")
 class FaceRepository:
-    def __init__(self, session: AsyncSession):
+    def __init__(
+        self,
+        session: AsyncSession,
+        read_session: ReadSession,
+        ef_search: Annotated[int, Inject(param="hnsw_ef_search")],
+        probes: Annotated[int, Inject(param="ivfflat_probes")],
+        iterative_scan: Annotated[bool, Inject(param="vector_iterative_scan")],
+        quantization: Annotated[str, Inject(param="vector_quantization")],
+        rerank_depth: Annotated[int, Inject(param="vector_rerank_depth")],
+        search_pool: SearchPool,
+    ):
+        # Writes and the reads of ingestion on the primary, searches, listings and counts on the replicas
         self._session = session
+        self._read_session = read_session
+        self._ef_search = ef_search
+        self._probes = probes
+        self._iterative_scan = iterative_scan
+        self._quantization = str_to_quantization_type(quantization)
+        self._rerank_depth = rerank_depth
+        self._search_pool = search_pool
 
-    async def find_faces_by_image_name(self, fn: str) -> Sequence[FaceRegion]:
-        return (await self._session.execute(select(FaceRegion).where(FaceRegion.filename.ilike(fn)))).scalars().all()
+    async def find_faces_by_image_name(self, fn: str) -> list[FaceRow]:
+        return await self._fetch_rows(self._select_rows().where(FaceRegion.filename.ilike(fn)))
 
-    async def find_random(self, limit: int, search: str) -> Sequence[FaceRegion]:
-        or_list = []
-        for term in re.split(r"\s+", search):
-            or_list.append(FaceRegion.filename.ilike(f"%{term}%"))
-            or_list.append(FaceRegion.model.ilike(f"%{term}%"))
+    async def find_random(self, limit: int, search: str) -> list[FaceRow]:
+        # Rows following a random point of the indexed sample_key, wrapping around at the end of the key range.
+        # Costs O(limit) whatever the table size, unlike sorting every matching row by random()
+        start = random.random()
+        q = self._select_rows().filter(self._search_filter(search)).order_by(FaceRegion.sample_key)
+
+        faces = await self._fetch_rows(q.filter(FaceRegion.sample_key >= start).limit(limit))
+        if len(faces) < limit:
+            faces.extend(await self._fetch_rows(q.filter(FaceRegion.sample_key < start).limit(limit - len(faces))))
+        return faces
 
-        q = select(FaceRegion).filter(or_(*or_list)).order_by(func.random()).limit(limit)
-        result = await self._session.execute(q)
-        return result.scalars().all()
+    async def find_page(self, limit: int, search: str, after_id: int | None = None) -> list[FaceRow]:
+        # Keyset on the primary key, every page is an index range scan however deep it is
+        q = self._select_rows().filter(self._search_filter(search)).order_by(FaceRegion.id).limit(limit)
+        if after_id is not None:
+            q = q.filter(FaceRegion.id > after_id)
+        return await self._fetch_rows(q)
 
     async def find_all_filenames(self) -> list[str]:
         result = await self._session.execute(select(FaceRegion.filename).group_by(FaceRegion.filename))
         return [str(filename) for filename in result.scalars().all()]
 
+    async def count_by_filename(self) -> dict[str, int]:
+        result = await self._session.execute(select(FaceRegion.filename, func.count()).group_by(FaceRegion.filename))
+        return {str(filename): int(count) for filename, count in result.all()}
+
+    async def bulk_insert(self, faces: Sequence[FaceRegion]) -> int:
+        if not faces:
+            return 0
+
+        if await is_asyncpg_session(self._session):
+            records = [self._to_copy_record(face) for face in faces]
+            async with asyncpg_connection(self._session) as conn:
+                await conn.copy_records_to_table(FaceRegion.__tablename__, records=records, columns=BULK_INSERT_COLUMNS)
+        else:
+            self._session.add_all(faces)
+            await self._session.flush()
+
+        return len(faces)
+
+    async def copy_faces(self, source_filename: str, target_filename: str) -> int:
+        columns = [col for col in BULK_INSERT_COLUMNS if col not in ("filename", "created_at")]
+        stmt = insert(FaceRegion).from_select(
+            ["filename", "created_at", *columns],
+            select(literal(target_filename), func.now(), *[getattr(FaceRegion, col) for col in columns]).where(
+                FaceRegion.filename == source_filename
+            ),
+        )
+        result = await self._session.execute(stmt)
+        return int(result.rowcount)
+
+    async def delete_by_filenames(self, filenames: Sequence[str]) -> list[tuple[int, str]]:
+        # Ids and models of the deleted rows
+        if not filenames:
+            return []
+        stmt = delete(FaceRegion).where(FaceRegion.filename.in_(filenames)).returning(FaceRegion.id, FaceRegion.model)
+        return [(row.id, row.model) for row in (await self._session.execute(stmt)).all()]
+
+    @staticmethod
+    def _to_copy_record(face: FaceRegion) -> tuple[object, ...]:
+        values = []
+        for col in BULK_INSERT_COLUMNS:
+            value = getattr(face, col)
+            if col in JSON_COLUMNS and value is not None:
+                value = json.dumps(value)
+            values.append(value)
+        return tuple(values)
+
     async def count_regions(self, since: datetime.datetime | None = None) -> int:
         stmt = select(func.count()).select_from(FaceRegion)
 
         if since is not None:
             stmt = stmt.where(FaceRegion.created_at >= since)
 
-        result = await self._session.execute(stmt)
+        result = await self._read_session.execute(stmt)
         return result.scalar_one()
 
-    async def find_face_by_id(self, id: int) -> FaceRegion | None:
-        q = select(FaceRegion).filter(FaceRegion.id == id)
-        result = await self._session.execute(q)
-        return result.scalars().first()
+    async def find_face_by_id(self, id: int) -> FaceRow | None:
+        faces = await self._fetch_rows(self._select_rows().filter(FaceRegion.id == id))
+        return faces[0] if faces else None
+
+    async def find_faces_by_ids(self, ids: Sequence[int]) -> dict[int, FaceRow]:
+        if not ids:
+            return {}
+        return {face.id: face for face in await self._fetch_rows(self._select_rows().filter(FaceRegion.id.in_(ids)))}
 
-    async def get_face_by_id(self, user_id: int) -> FaceRegion:
+    async def get_face_by_id(self, user_id: int) -> FaceRow:
         res = await self.find_face_by_id(user_id)
         if res is not None:
             return res
         raise FaceRepositoryException()
 
+    async def get_face_vector(self, id: int) -> np.ndarray:
+        q = select(FaceRegion).options(undefer_group(EMBEDDING_GROUP)).filter(FaceRegion.id == id)
+        face = (await self._read_session.execute(q)).scalars().first()
+        if face is None:
+            raise FaceRepositoryException()
+        return face.get_vector()
+
+    async def find_face_vectors(self, ids: Sequence[int]) -> dict[int, np.ndarray]:
+        if not ids:
+            return {}
+        q = select(FaceRegion).options(undefer_group(EMBEDDING_GROUP)).filter(FaceRegion.id.in_(ids))
+        return {face.id: face.get_vector() for face in (await self._read_session.execute(q)).scalars()}
+
     async def find_similar_faces(
         self,
         target_vector: np.ndarray,
@@ -63,46 +205,322 @@ class FaceRepository:
         offset: int = 0,
         limit: int = 10,
         quality: int | None = None,
-    ) -> list[tuple[FaceRegion, float]]:
-        if model == "VGG-Face":
-            vector_column = FaceRegion.emb_4096
-        elif model == "Facenet":
-            vector_column = FaceRegion.emb_128
-        elif model in ("ArcFace", "Facenet512"):
-            vector_column = FaceRegion.emb_512
-        else:
-            raise ValueError(f"Model '{model}' is not supported.")
-
-        if metric == "l2":
-            distance_func = func.l2_distance
-        elif metric == "cosine":
-            distance_func = func.cosine_distance
-        else:
-            raise ValueError(f"Metric '{metric}' is not supported.")
+        ef_search: int | None = None,
+        probes: int | None = None,
+        after: tuple[float, int] | None = None,
+        depth: int = 0,
+    ) -> list[SimilarFace]:
+        # Rows before the cursor are filtered out, the iterative scan keeps going until a full page is found.
+        # Without it the index scan ends after ef_search rows, so the depth rows of the previous pages are read
+        # again and skipped outside the scan
+        scan_after = after if self._iterative_scan else None
+        nearest_count = offset + limit + KEYSET_TIE_MARGIN
+        if after is not None and scan_after is None:
+            nearest_count += depth
+            if self._candidate_count(nearest_count, metric) > HNSW_MAX_EF_SEARCH:
+                raise InvalidCursor(f"Pages past the {HNSW_MAX_EF_SEARCH} nearest faces need VECTOR_ITERATIVE_SCAN")
+        filtered = quality is not None or scan_after is not None
+        settings = self._search_settings(self._candidate_count(nearest_count, metric), filtered, ef_search, probes)
 
         if not isinstance(target_vector, np.ndarray):
             target_vector = np.array(target_vector)
+        if self._search_pool.enabled and not self._reranked(metric):
+            return await self._find_similar_faces_raw(
+                target_vector, model, metric, offset, limit, nearest_count, quality, after, scan_after, settings
+            )
+        await self._tune_vector_search(settings)
 
-        target_vector_db = cast(target_vector.tolist(), VECTOR())
+        faces, filters = self._search_scope(model, metric, target_vector, nearest_count, quality, scan_after)
+        order, distance = self._distance(model, metric, target_vector, faces)
+        if scan_after is not None:
+            filters.append(order >= scan_after[0])
+        # Vector indexes only serve an ORDER BY of the distance alone before PostgreSQL 17, the id tie-break and
+        # the cursor are applied on the few nearest rows outside
+        nearest = (
+            self._select_rows(faces, distance.label("distance"), order.label("sort_key"))
+            .filter(*filters)
+            .order_by(order)
+            .limit(nearest_count)
+            .subquery()
+        )
+        query = select(nearest).order_by(nearest.c.sort_key, nearest.c.id).offset(offset).limit(limit)
+        if after is not None:
+            query = query.filter(self._after_filter(nearest.c.sort_key, nearest.c.id, after))
 
-        query = (
-            select(
-                FaceRegion,
-                distance_func(vector_column, target_vector_db).label("distance"),
+        result = await self._read_session.execute(query)
+        size = len(FaceRow._fields)
+
+        return [SimilarFace(FaceRow(*row[:size]), row.distance, row.sort_key) for row in result.all()]
+
+    async def find_similar_faces_batch(
+        self,
+        target_vectors: Sequence[np.ndarray],
+        model: ModelType,
+        metric: MetricType,
+        limit: int = 10,
+        quality: int | None = None,
+        ef_search: int | None = None,
+        probes: int | None = None,
+    ) -> list[list[SimilarFace]]:
+        # One statement for all vectors, a top-k branch per vector so every one of them is an index scan of its own
+        if not target_vectors:
+            return []
+
+        settings = self._search_settings(self._candidate_count(limit, metric), quality is not None, ef_search, probes)
+        await self._tune_vector_search(settings)
+
+        branches = []
+        for i, target_vector in enumerate(target_vectors):
+            target_vector = np.asarray(target_vector)
+            faces, filters = self._search_scope(model, metric, target_vector, limit, quality)
+            order, distance = self._distance(model, metric, target_vector, faces)
+            columns = (distance.label("distance"), order.label("sort_key"), literal(i).label("query"))
+            branches.append(self._select_rows(faces, *columns).filter(*filters).order_by(order).limit(limit))
+
+        result = await self._read_session.execute(union_all(*branches))
+        size = len(FaceRow._fields)
+        matches: list[list[SimilarFace]] = [[] for _ in target_vectors]
+        for row in result.all():
+            matches[row.query].append(SimilarFace(FaceRow(*row[:size]), row.distance, row.sort_key))
+        # UNION ALL keeps no order, every query is sorted again like a single search
+        return [sorted(faces, key=lambda match: (match.sort_key, match.face.id)) for faces in matches]
+
+    async def count_similar_faces(
+        self,
+        target_vectors: Sequence[np.ndarray],
+        model: ModelType,
+        metric: MetricType,
+        max_distance: float,
+        limit: int,
+        quality: int | None = None,
+        ef_search: int | None = None,
+        probes: int | None = None,
+    ) -> list[int]:
+        # One statement for all vectors, each count is capped at limit so the nearest-neighbour index stays usable
+        if not target_vectors:
+            return []
+
+        await self._tune_vector_search(
+            self._search_settings(self._candidate_count(limit, metric), quality is not None, ef_search, probes)
+        )
+
+        counts = []
+        for i, target_vector in enumerate(target_vectors):
+            target_vector = np.asarray(target_vector)
+            faces, filters = self._search_scope(model, metric, target_vector, limit, quality)
+            order, distance = self._distance(model, metric, target_vector, faces)
+            # The distance bound stays outside the materialized top-k, inside it an index scan that never fills the
+            # limit would go on until hnsw.max_scan_tuples with the iterative scan of filtered searches
+            nearest = (
+                select(distance.label("distance"))
+                .filter(*filters)
+                .order_by(order)
+                .limit(limit)
+                .cte(f"nearest_{i}")
+                .prefix_with("MATERIALIZED")
+            )
+            counts.append(
+                select(func.count()).select_from(nearest).filter(nearest.c.distance <= max_distance).scalar_subquery()
             )
-            .filter(FaceRegion.model == model)
-            .order_by("distance")
-            .offset(offset)
-            .limit(limit)
+
+        result = await self._read_session.execute(select(*counts))
+        return [int(count) for count in result.one()]
+
+    async def _find_similar_faces_raw(
+        self,
+        target_vector: np.ndarray,
+        model: ModelType,
+        metric: MetricType,
+        offset: int,
+        limit: int,
+        nearest_count: int,
+        quality: int | None,
+        after: tuple[float, int] | None,
+        scan_after: tuple[float, int] | None,
+        settings: dict[str, str],
+    ) -> list[SimilarFace]:
+        # Hand-written twin of the SQLAlchemy query of find_similar_faces on the search pool, for the cosine searches
+        # without re-ranking. The query vector is bound as a binary float32 vector, the statement text only varies
+        # with model and filters
+        if metric != "cosine":
+            raise ValueError(f"Metric '{metric}' searches re-rank candidates and are not supported here.")
+        column = self._vector_column(model).key
+        args: list[Any] = [normalize(target_vector).astype(np.float32)]
+        order = f"({column} <#> $1::vector)"
+        distance = f"greatest({order} + 1.0, 0.0)"
+
+        # Model inline as in _model_filter, validated by _vector_column
+        filters = [f"model = '{model}'"]
+        if quality is not None:
+            args.append(float(quality))
+            filters.append(f"face_quality = ${len(args)}::float8")
+        cursor = "TRUE"
+        if after is not None:
+            args.extend(after)
+            key, face_id = f"${len(args) - 1}::float8", f"${len(args)}::integer"
+            if scan_after is not None:
+                filters.append(f"{order} >= {key}")
+            cursor = f"(sort_key > {key} OR (sort_key = {key} AND id > {face_id}))"
+        args.extend((nearest_count, offset, limit))
+
+        # Same shape as the SQLAlchemy query, the index serves the inner ORDER BY of the distance alone
+        query = (
+            f"SELECT * FROM (SELECT {', '.join(FaceRow._fields)}, {distance} AS distance, {order} AS sort_key "
+            f"FROM {FaceRegion.__tablename__} WHERE {' AND '.join(filters)} "
+            f"ORDER BY {order} LIMIT ${len(args) - 2}) AS nearest "
+            f"WHERE {cursor} ORDER BY sort_key, id OFFSET ${len(args) - 1} LIMIT ${len(args)}"
         )
+        size = len(FaceRow._fields)
+        rows = [tuple(row) for row in await self._search_pool.fetch(settings, query, *args)]
+        return [SimilarFace(FaceRow(*row[:size]), row[size], row[size + 1]) for row in rows]
+
+    async def _tune_vector_search(self, settings: dict[str, str]) -> None:
+        # Transaction-local settings, the pooled connection is back on the server defaults afterwards
+        await self._read_session.execute(
+            select(*[func.set_config(name, value, True) for name, value in settings.items()])
+        )
+
+    def _search_settings(
+        self, result_count: int, filtered: bool, ef_search: int | None, probes: int | None
+    ) -> dict[str, str]:
+        ef_search = ef_search if ef_search is not None else self._ef_search
+        probes = probes if probes is not None else self._probes
+
+        # An HNSW scan returns at most ef_search rows, fewer than requested would silently truncate the result
+        settings = {"hnsw.ef_search": str(max(ef_search, result_count))}
+        if probes > 0:
+            settings["ivfflat.probes"] = str(probes)
+        if filtered and self._iterative_scan:
+            # Rows dropped by extra filters are replaced by scanning further instead of shrinking the result
+            settings["hnsw.iterative_scan"] = "strict_order"
+            settings["ivfflat.iterative_scan"] = "relaxed_order"
+        return settings
+
+    @staticmethod
+    def _select_rows(faces: type[FaceRegion] | AliasedClass[FaceRegion] = FaceRegion, *extra: Any) -> Select[Any]:
+        return select(*[getattr(faces, name) for name in FaceRow._fields], *extra)
+
+    async def _fetch_rows(self, query: Select[Any]) -> list[FaceRow]:
+        return [FaceRow(*row) for row in (await self._read_session.execute(query)).all()]
 
+    def _reranked(self, metric: MetricType) -> bool:
+        # The vector indexes order by inner product of the normalized vectors, L2 depends on the norms as well
+        return self._quantization != "none" or metric == "l2"
+
+    def _candidate_count(self, result_count: int, metric: MetricType) -> int:
+        return max(result_count, self._rerank_depth) if self._reranked(metric) else result_count
+
+    def _search_scope(
+        self,
+        model: ModelType,
+        metric: MetricType,
+        target_vector: np.ndarray,
+        result_count: int,
+        quality: int | None,
+        after: tuple[float, int] | None = None,
+    ) -> tuple[type[FaceRegion] | AliasedClass[FaceRegion], list[ColumnElement[bool]]]:
+        filters = [self._model_filter(model)]
         if quality is not None:
-            query = query.filter(FaceRegion.face_quality == quality)
+            filters.append(FaceRegion.face_quality == quality)
+        if not self._reranked(metric):
+            return FaceRegion, filters
+
+        if after is not None:
+            # Candidates of the next pages only, the exact sort key decides what the previous pages returned
+            filters.append(self._after_filter(self._distance(model, metric, target_vector)[0], FaceRegion.id, after))
+
+        # Nearest candidates by their compact codes or by cosine for L2, the caller re-ranks them by the exact
+        # distance. Only the exact distance reads the full vector, it is the one embedding column carried along
+        candidates = (
+            self._select_rows(FaceRegion, self._vector_column(model), FaceRegion.emb_norm)
+            .filter(*filters)
+            .order_by(self._candidate_distance(model, target_vector))
+            .limit(self._candidate_count(result_count, metric))
+            .subquery()
+        )
+        return aliased(FaceRegion, candidates), []
+
+    def _candidate_distance(self, model: ModelType, target_vector: np.ndarray) -> ColumnElement[float]:
+        # Same expressions as the indexes of VectorIndexManager, candidates of both metrics by similarity
+        dimensions = MODEL_VECTOR_SIZES[model]
+        vector_column = self._vector_column(model)
+        if self._quantization == "none":
+            return vector_column.max_inner_product(cast(normalize(target_vector).tolist(), VECTOR()))
+        elif self._quantization == "halfvec":
+            codes = cast(vector_column, HALFVEC(dimensions))
+            return codes.max_inner_product(cast(normalize(target_vector).tolist(), HALFVEC(dimensions)))
+        elif self._quantization == "binary":
+            codes = cast(func.binary_quantize(vector_column), BIT(dimensions))
+            return codes.hamming_distance(func.binary_quantize(cast(target_vector.tolist(), VECTOR(dimensions))))
+        raise ValueError(
+            f"pgvector has no {self._quantization} vectors, {self._quantization} codes need the mmap backend"
+        )
 
-        result = await self._session.execute(query)
-        rows = result.all()
+    @staticmethod
+    def _after_filter(
+        order: ColumnElement[float], ids: ColumnElement[int], after: tuple[float, int]
+    ) -> ColumnElement[bool]:
+        sort_key, face_id = after
+        return or_(order > sort_key, and_(order == sort_key, ids > face_id))
 
-        return [(row[0], row.distance) for row in rows]
+    @staticmethod
+    def _model_filter(model: ModelType) -> ColumnElement[bool]:
+        # Rendered inline, the planner can only match the partial per-model vector indexes against a constant
+        return FaceRegion.model == literal(model, literal_execute=True)
+
+    @staticmethod
+    def _vector_column(
+        model: ModelType, faces: type[FaceRegion] | AliasedClass[FaceRegion] = FaceRegion
+    ) -> InstrumentedAttribute[np.ndarray | None]:
+        if model == "VGG-Face":
+            return faces.emb_4096
+        elif model == "Facenet":
+            return faces.emb_128
+        elif model in ("ArcFace", "Facenet512"):
+            return faces.emb_512
+        raise ValueError(f"Model '{model}' is not supported.")
+
+    @staticmethod
+    def _search_filter(search: str) -> ColumnElement[bool]:
+        # Shorter terms are dropped, a search of only short terms lists every face
+        terms = [term for term in re.split(r"\s+", search) if len(term) >= SEARCH_MIN_TERM_LENGTH]
+        if not terms:
+            return true()
+
+        or_list = []
+        for term in terms:
+            escaped = re.sub(r"([\\%_])", r"\\\1", term)
+            or_list.append(FaceRegion.filename.ilike(f"%{escaped}%", escape="\\"))
+            # The few model names are matched here, an equality filter instead of a scan of the model column
+            models = [model for model in MODEL_VECTOR_SIZES if term.lower() in model.lower()]
+            if models:
+                or_list.append(FaceRegion.model.in_(models))
+        return or_(*or_list)
+
+    @classmethod
+    def _distance(
+        cls,
+        model: ModelType,
+        metric: MetricType,
+        target_vector: np.ndarray,
+        faces: type[FaceRegion] | AliasedClass[FaceRegion] = FaceRegion,
+    ) -> tuple[ColumnElement[float], ColumnElement[float]]:
+        # Sort key and distance. Stored vectors have unit length, so the inner-product operator orders by cosine
+        # and can be answered from a vector index. The L2 expression cannot, it re-ranks candidates of the index.
+        # Distances are converted back to those of the raw embeddings
+        vector_column = cls._vector_column(model, faces)
+        unit_target: ColumnElement[Any] = cast(normalize(target_vector).tolist(), VECTOR())
+        # <#> is the negative inner product
+        negative_similarity = vector_column.max_inner_product(unit_target)
+        if metric == "cosine":
+            return negative_similarity, func.greatest(negative_similarity + 1.0, 0.0, type_=Float)
+        elif metric == "l2":
+            norm = faces.emb_norm
+            target_norm = float(np.linalg.norm(target_vector))
+            squared = norm * norm + target_norm**2 + 2.0 * target_norm * norm * negative_similarity
+            distance = func.sqrt(func.greatest(squared, 0.0, type_=Float), type_=Float)
+            return distance, distance
+        raise ValueError(f"Metric '{metric}' is not supported.")
 
 
 class FaceRepositoryException(Exception):
@@ -1,5 +1,5 @@
+import asyncio
 import hashlib
-import tempfile
 from typing import Annotated
 
 import numpy as np
@@ -14,11 +14,13 @@ from app.app_config import (
     METRIC_DEFAULT,
     MODEL_DEFAULT,
 )
-from app.face_model_invoker import FaceModelInterface
-from app.face_region import FaceRegion
-from app.face_repository import FaceRepository
+from app.face_model_invoker import AsyncFaceModelInterface, FaceEmbeddingList
+from app.face_repository import FaceRepository, FaceRow, SimilarFace
 from app.helpers import str_to_metric_type, str_to_model_type
 from app.image_processor import crop_and_save
+from app.pagination import decode_cursor, encode_cursor
+from app.upload_cache import UploadEmbeddingCache, UploadNotCached
+from app.vector_store import MmapVectorStore
 
 
 class FaceItem(BaseModel):
@@ -40,6 +42,16 @@ class FaceSimilarItem(FaceItem):
     quality: NonNegativeFloat
 
 
+class FacePage(BaseModel):
+    items: list[FaceItem]
+    next_cursor: str | None
+
+
+class FaceSimilarPage(BaseModel):
+    items: list[FaceSimilarItem]
+    next_cursor: str | None
+
+
 class AnalyzeBox(BaseModel):
     x: NonNegativeInt
     y: NonNegativeInt
@@ -49,19 +61,30 @@ class AnalyzeBox(BaseModel):
     similar_faces: NonNegativeInt
 
 
+class AnalyzedImage(BaseModel):
+    handle: str
+    boxes: list[AnalyzeBox]
+
+
 @service(lifetime="scoped")
 class FaceService:
     def __init__(
         self,
         face_repository: FaceRepository,
-        face_engine: FaceModelInterface,
+        face_engine: AsyncFaceModelInterface,
+        upload_cache: UploadEmbeddingCache,
+        vector_store: MmapVectorStore,
         model_thresholds: Annotated[dict[str, float], Inject(param="model_thresholds")],
+        vector_search_backend: Annotated[str, Inject(param="vector_search_backend")],
     ):
         self._face_repository = face_repository
         self._face_engine = face_engine
+        self._upload_cache = upload_cache
+        self._vector_store = vector_store
         self._model_thresholds = model_thresholds
+        self._vector_search_backend = vector_search_backend
 
-    def map_face_region_to_item(self, face: FaceRegion) -> FaceItem:
+    def map_face_region_to_item(self, face: FaceRow) -> FaceItem:
         return FaceItem(
             id=face.id,
             fn=face.filename,
@@ -78,7 +101,15 @@ class FaceService:
     async def find_list(self, limit: int, search: str) -> list[FaceItem]:
         return [self.map_face_region_to_item(item) for item in await self._face_repository.find_random(limit, search)]
 
-    def create_preview(self, face: FaceRegion) -> str:
+    async def find_page(self, limit: int, search: str, cursor: str | None) -> FacePage:
+        after_id = decode_cursor(cursor, int)[0] if cursor else None
+        faces = await self._face_repository.find_page(limit, search, after_id)
+        return FacePage(
+            items=[self.map_face_region_to_item(face) for face in faces],
+            next_cursor=encode_cursor(faces[-1].id) if len(faces) == limit else None,
+        )
+
+    def create_preview(self, face: FaceRow) -> str:
         new_fn = hashlib.sha1(face.filename.encode()).hexdigest() + f"{face.x}_{face.y}_{face.w}_{face.h}.jpg"
 
         crop_and_save(
@@ -99,31 +130,31 @@ class FaceService:
     async def get_by_id(self, id: int) -> FaceItem:
         return self.map_face_region_to_item(await self._face_repository.get_face_by_id(id))
 
-    async def analyze_image(self, file: UploadFile) -> list[AnalyzeBox]:
+    async def represent_upload(self, contents: bytes) -> tuple[str, FaceEmbeddingList]:
+        handle = self._upload_cache.key(contents)
+        faces_data = self._upload_cache.get(handle)
+        if faces_data is None:
+            faces_data = await self._face_engine.represent_face(contents)
+            self._upload_cache.put(handle, faces_data)
+        return handle, faces_data
+
+    async def analyze_image(self, file: UploadFile) -> AnalyzedImage:
         output: list[AnalyzeBox] = []
 
-        contents = await file.read()
-        # image = Image.open(io.BytesIO(contents), formats=None).convert("RGB")
-        # img_array = np.array(image)
-        # faces_data = self.represent_face(img_path=img_array)
-        # TODO
-        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=True) as tmp:
-            tmp.write(contents)
-            tmp_path = tmp.name
-            faces_data = self._face_engine.represent_face(img_path=tmp_path)
+        handle, faces_data = await self.represent_upload(await file.read())
 
-        for data in faces_data:
-            emb = data.embedding
-            similar_faces = await self.find_similar_by_vector(
-                target_vector=np.array(emb),
-                model=str_to_model_type(MODEL_DEFAULT),
-                metric=str_to_metric_type(METRIC_DEFAULT),
-                offset=0,
-                limit=100,
-                quality=1,
-            )
-            similar_faces = [item for item in similar_faces if item.distance <= self._model_thresholds[MODEL_DEFAULT]]
+        # Matches are only counted, the threshold is applied by the search and no rows or previews are loaded.
+        # Clients fetch the matches of a face with /similar-to-image
+        similar_counts = await self.count_similar(
+            target_vectors=[np.array(data.embedding) for data in faces_data],
+            model=MODEL_DEFAULT,
+            metric=METRIC_DEFAULT,
+            max_distance=self._model_thresholds[MODEL_DEFAULT],
+            limit=100,
+            quality=1,
+        )
 
+        for data, similar_faces in zip(faces_data, similar_counts, strict=True):
             output.append(
                 AnalyzeBox(
                     x=data.facial_area.x,
@@ -131,25 +162,57 @@ class FaceService:
                     w=data.facial_area.w,
                     h=data.facial_area.h,
                     face_confidence=data.face_confidence,
-                    similar_faces=len(similar_faces),
+                    similar_faces=similar_faces,
                 )
             )
 
-        return output
+        return AnalyzedImage(handle=handle, boxes=output)
+
+    async def count_similar(
+        self,
+        target_vectors: list[np.ndarray],
+        model: str,
+        metric: str,
+        max_distance: float,
+        limit: int,
+        quality: int | None,
+    ) -> list[int]:
+        if self._vector_search_backend == "mmap":
+            return await asyncio.to_thread(
+                lambda: [
+                    self._vector_store.count_similar(
+                        str_to_model_type(model), vector, str_to_metric_type(metric), max_distance, limit, quality
+                    )
+                    for vector in target_vectors
+                ]
+            )
+        return await self._face_repository.count_similar_faces(
+            target_vectors=target_vectors,
+            model=str_to_model_type(model),
+            metric=str_to_metric_type(metric),
+            max_distance=max_distance,
+            limit=limit,
+            quality=quality,
+        )
 
     async def find_similar_by_image(
-        self, file: UploadFile, x: int, y: int, w: int, h: int, limit: int, offset: int, quality: int | None
-    ) -> list[FaceSimilarItem]:
-        contents = await file.read()
-        # image = Image.open(io.BytesIO(contents)).convert("RGB")
-        # img_array = np.array(image)
-        # cropped_array = img_array[y:y+h, x:x+w, :]
-        # faces_data = self.represent_face(img_path=img_array)
-        # TODO
-        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=True) as tmp:
-            tmp.write(contents)
-            tmp_path = tmp.name
-            faces_data = self._face_engine.represent_face(img_path=tmp_path)
+        self,
+        file: UploadFile | None,
+        handle: str | None,
+        x: int,
+        y: int,
+        w: int,
+        h: int,
+        limit: int,
+        cursor: str | None,
+        quality: int | None,
+    ) -> FaceSimilarPage:
+        # The handle returned by analyze_image avoids both the upload and the inference, the image is the fallback
+        faces_data = self._upload_cache.get(handle) if handle else None
+        if faces_data is None:
+            if file is None:
+                raise UploadNotCached("Uploaded image is no longer cached, send it again")
+            _, faces_data = await self.represent_upload(await file.read())
 
         vector = None
         for data in faces_data:
@@ -167,50 +230,118 @@ class FaceService:
             metric=METRIC_DEFAULT,
             quality=quality,
             limit=limit,
-            offset=offset,
+            cursor=cursor,
         )
 
     async def find_similar_by_face_id(
-        self, id: int, model: str, metric: str, limit: int, quality: int | None
-    ) -> list[FaceSimilarItem]:
-        face_row = await self._face_repository.get_face_by_id(id)
-        target_vector = face_row.get_vector()
+        self, id: int, model: str, metric: str, limit: int, cursor: str | None, quality: int | None
+    ) -> FaceSimilarPage:
+        target_vector = await self._face_repository.get_face_vector(id)
         return await self.find_similar_by_vector(
-            target_vector=target_vector, model=model, metric=metric, limit=limit, quality=quality, offset=0
+            target_vector=target_vector, model=model, metric=metric, limit=limit, cursor=cursor, quality=quality
         )
 
     async def find_similar_by_vector(
-        self, target_vector: np.ndarray, model: str, metric: str, limit: int, offset: int, quality: int | None
-    ) -> list[FaceSimilarItem]:
-        similar_faces = await self._face_repository.find_similar_faces(
-            target_vector=target_vector,
-            model=str_to_model_type(model),
-            metric=str_to_metric_type(metric),
-            limit=limit,
-            quality=quality,
+        self, target_vector: np.ndarray, model: str, metric: str, limit: int, cursor: str | None, quality: int | None
+    ) -> FaceSimilarPage:
+        # Pages are keyed on (sort key, id) of their last row and the count of rows before it. The index scan
+        # still walks the rows of the previous pages, up to hnsw.max_scan_tuples with the iterative scan
+        after: tuple[float, int] | None = None
+        depth = 0
+        if cursor:
+            sort_key, after_id, depth = decode_cursor(cursor, float, int, int)
+            after = (sort_key, after_id)
+
+        if self._vector_search_backend == "mmap":
+            hits = await asyncio.to_thread(
+                self._vector_store.search,
+                model=str_to_model_type(model),
+                target_vector=target_vector,
+                metric=str_to_metric_type(metric),
+                limit=limit,
+                quality=quality,
+                after=after,
+            )
+            faces = await self._face_repository.find_faces_by_ids([face_id for face_id, _ in hits])
+            # Rows deleted since the matrix was built are skipped, the cursor still moves past them
+            similar_faces = [
+                SimilarFace(faces[face_id], distance, distance) for face_id, distance in hits if face_id in faces
+            ]
+            last_key = (hits[-1][1], hits[-1][0]) if len(hits) == limit else None
+        else:
+            similar_faces = await self._face_repository.find_similar_faces(
+                target_vector=target_vector,
+                model=str_to_model_type(model),
+                metric=str_to_metric_type(metric),
+                limit=limit,
+                quality=quality,
+                after=after,
+                depth=depth,
+            )
+            last = similar_faces[-1] if len(similar_faces) == limit else None
+            last_key = (last.sort_key, last.face.id) if last is not None else None
+
+        resp = [self.map_similar_face_to_item(face, distance) for face, distance, _ in similar_faces]
+
+        next_cursor = encode_cursor(*last_key, depth + limit) if last_key is not None else None
+        return FaceSimilarPage(items=resp, next_cursor=next_cursor)
+
+    async def find_similar_by_face_ids(
+        self, ids: list[int], model: str, metric: str, limit: int, quality: int | None
+    ) -> dict[int, list[FaceSimilarItem]]:
+        # Unknown ids are left out of the result
+        vectors = await self._face_repository.find_face_vectors(ids)
+        found = [face_id for face_id in dict.fromkeys(ids) if face_id in vectors]
+        results = await self.find_similar_batch(
+            [vectors[face_id] for face_id in found], model=model, metric=metric, limit=limit, quality=quality
         )
-
-        resp: list[FaceSimilarItem] = []
-
-        for face, distance in similar_faces:
-            new_fn = self.create_preview(face)
-
-            resp.append(
-                FaceSimilarItem(
-                    id=face.id,
-                    fn=face.filename,
-                    confidence=round(face.face_confidence * 100),
-                    distance=distance,
-                    quality=face.face_quality,
-                    model=face.model,
-                    preview_path=new_fn,
-                    source_filepath=face.filename,
-                    is_same=self._model_thresholds[face.model] >= distance,
-                    x=face.x,
-                    y=face.y,
-                    w=face.w,
-                    h=face.h,
-                )
+        return dict(zip(found, results, strict=True))
+
+    async def find_similar_batch(
+        self, target_vectors: list[np.ndarray], model: str, metric: str, limit: int, quality: int | None
+    ) -> list[list[FaceSimilarItem]]:
+        # Top matches of every vector in one statement, or in one worker thread over the mapped matrix
+        model_type = str_to_model_type(model)
+        metric_type = str_to_metric_type(metric)
+
+        if self._vector_search_backend == "mmap":
+            hits = await asyncio.to_thread(
+                lambda: [
+                    self._vector_store.search(model_type, vector, metric_type, limit, quality=quality)
+                    for vector in target_vectors
+                ]
+            )
+            faces = await self._face_repository.find_faces_by_ids(
+                list({face_id for query_hits in hits for face_id, _ in query_hits})
             )
+            matches = [
+                [
+                    SimilarFace(faces[face_id], distance, distance)
+                    for face_id, distance in query_hits
+                    if face_id in faces
+                ]
+                for query_hits in hits
+            ]
+        else:
+            matches = await self._face_repository.find_similar_faces_batch(
+                target_vectors=target_vectors, model=model_type, metric=metric_type, limit=limit, quality=quality
+            )
+
+        return [[self.map_similar_face_to_item(face, distance) for face, distance, _ in query] for query in matches]
 
-        return resp
+    def map_similar_face_to_item(self, face: FaceRow, distance: float) -> FaceSimilarItem:
+        return FaceSimilarItem(
+            id=face.id,
+            fn=face.filename,
+            confidence=round(face.face_confidence * 100),
+            distance=distance,
+            quality=face.face_quality,
+            model=face.model,
+            preview_path=self.create_preview(face),
+            source_filepath=face.filename,
+            is_same=self._model_thresholds[face.model] >= distance,
+            x=face.x,
+            y=face.y,
+            w=face.w,
+            h=face.h,
+        )
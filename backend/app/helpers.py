@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import hashlib
 from enum import Enum
 from typing import Literal, TypeVar, cast
 
@@ -26,6 +27,8 @@ ModelType = Literal["VGG-Face", "Facenet", "ArcFace", "Facenet512"]
 
 MetricType = Literal["l2", "cosine"]
 
+QuantizationType = Literal["none", "halfvec", "int8", "binary"]
+
 
 def str_to_model_type(s: str) -> ModelType:
     if s in ["VGG-Face", "Facenet", "ArcFace", "Facenet512"]:
@@ -39,6 +42,20 @@ def str_to_metric_type(s: str) -> MetricType:
     raise ValueError(f"{s} is not a valid metric")
 
 
+def str_to_quantization_type(s: str) -> QuantizationType:
+    if s in ["none", "halfvec", "int8", "binary"]:
+        return cast(QuantizationType, s)
+    raise ValueError(f"{s} is not a valid quantization")
+
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def normalize(vector: np.ndarray) -> np.ndarray:
     norm = np.linalg.norm(vector)
     if norm == 0:
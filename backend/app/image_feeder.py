@@ -1,15 +1,67 @@
+import asyncio
+import multiprocessing
 import os
-from collections.abc import Awaitable, Callable
+import time
+from collections.abc import Awaitable, Callable, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Annotated, NamedTuple
 
 import numpy as np
 from sqlalchemy.ext.asyncio import AsyncSession
-from wireup import service
+from wireup import Inject, service
 
-from app.app_config import IMG_ORIG_DIR, MODEL_DEFAULT
-from app.face_model_invoker import FaceModelInterface
+from app.app_config import FEEDER_REPORT_EVERY, IMG_ORIG_DIR, MODEL_DEFAULT
+from app.face_model_invoker import (
+    FaceEmbedding,
+    FaceEmbeddingList,
+    FaceModelRegistry,
+    LocalFaceModel,
+    NoFaceFound,
+)
 from app.face_region import FaceRegion
+from app.face_region_writer import FaceRegionBatchWriter
 from app.face_repository import FaceRepository
 from app.face_service import FaceService
+from app.helpers import ModelType, file_sha256, str_to_model_type
+from app.image_processor import perceptual_hash
+from app.ingested_image import ImageRecord, IngestStatus
+from app.ingested_image_repository import IngestedImageRepository
+from app.vector_store import MmapVectorStore
+
+# Per-process state of the feeder workers, every worker loads its own copy of the models
+_worker_engine: LocalFaceModel | None = None
+
+
+def _init_worker(detector_backend: str, max_detection_side: int, model_names: Sequence[str]) -> None:
+    global _worker_engine
+    registry = FaceModelRegistry(detector_backend=detector_backend)
+    registry.warm_up(model_names)
+    _worker_engine = LocalFaceModel(registry=registry, model_name=model_names[0], max_detection_side=max_detection_side)
+
+
+def _represent_in_worker(img_path: str, model_names: Sequence[str]) -> dict[str, FaceEmbeddingList]:
+    if _worker_engine is None:
+        raise RuntimeError("Feeder worker is not initialized")
+    return _worker_engine.represent_face_multi(img_path, model_names)
+
+
+class ScannedImage(NamedTuple):
+    path: str
+    size: int
+    mtime_ns: int
+    known: ImageRecord | None
+
+
+class FeederJob(NamedTuple):
+    image: ScannedImage
+    content_hash: str
+    perceptual_hash: str | None
+    # Faces per embedding model, None when the image needs no inference and only its manifest record is refreshed
+    result: asyncio.Future[dict[str, FaceEmbeddingList]] | None
+    replace: bool
+    # Path of an already ingested image with the same content, its faces are copied instead of running inference
+    alias_of: str | None = None
 
 
 @service(lifetime="scoped")
@@ -17,74 +69,287 @@ class ImageFeeder:
     def __init__(
         self,
         face_repository: FaceRepository,
+        image_repository: IngestedImageRepository,
         face_service: FaceService,
-        face_engine: FaceModelInterface,
         session: AsyncSession,
+        detector_backend: Annotated[str, Inject(param="detector_backend")],
+        max_detection_side: Annotated[int, Inject(param="max_detection_side")],
+        models: Annotated[list[str], Inject(param="feeder_models")],
+        workers: Annotated[int, Inject(param="feeder_workers")],
+        queue_size: Annotated[int, Inject(param="feeder_queue_size")],
+        batch_size: Annotated[int, Inject(param="feeder_batch_size")],
+        flush_seconds: Annotated[float, Inject(param="feeder_flush_seconds")],
+        perceptual_dedup: Annotated[bool, Inject(param="feeder_perceptual_dedup")],
+        vector_store: MmapVectorStore,
+        vector_search_backend: Annotated[str, Inject(param="vector_search_backend")],
     ):
         self._face_repo = face_repository
+        self._image_repo = image_repository
         self._face_service = face_service
-        self._face_engine = face_engine
         self._session = session
+        self._detector_backend = detector_backend
+        self._max_detection_side = max_detection_side
+        self._models: list[ModelType] = [str_to_model_type(model) for model in models or [MODEL_DEFAULT]]
+        self._workers = workers
+        self._queue_size = max(1, queue_size)
+        self._batch_size = batch_size
+        self._flush_seconds = flush_seconds
+        self._perceptual_dedup = perceptual_dedup
+        self._vector_store = vector_store
+        self._vector_search_backend = vector_search_backend
 
     async def process(self, progress_cb: Callable[[str], Awaitable[None]] | None = None):
         async def send_msg(s: str):
+            print(s)
             if progress_cb:
                 await progress_cb(s)
 
-        models = [
-            # 'Facenet',
-            # 'Facenet512',
-            # 'VGG-Face',
-            MODEL_DEFAULT
-        ]
+        known_images = await self._image_repo.find_all_records()
+        new_files = self._scan_changed_images(known_images)
+
+        await send_msg(
+            f"Found {len(new_files)} new or changed images, models: {', '.join(self._models)}, workers: {self._workers}"
+        )
+
+        # Images ingested before the manifest existed get a record without running inference again
+        legacy_faces: dict[str, int] = {}
+        if any(image.known is None for image in new_files):
+            legacy_faces = await self._face_repo.count_by_filename()
+
+        # Content index of ingested images for deduplication, paths rescanned in this run are not valid sources
+        changed_paths = {image.path for image in new_files}
+        by_content: dict[str, str] = {}
+        by_perceptual: dict[str, str] = {}
+        for record in known_images.values():
+            if record.status == "error" or record.path in changed_paths:
+                continue
+            by_content.setdefault(record.content_hash, record.path)
+            if record.perceptual_hash is not None:
+                by_perceptual.setdefault(record.perceptual_hash, record.path)
+
+        # Bounded queue of in-flight jobs, the producer blocks once the writer falls behind
+        queue: asyncio.Queue[FeederJob | None] = asyncio.Queue(maxsize=self._queue_size)
+        executor = self._create_executor()
+
+        async def produce() -> None:
+            for image in new_files:
+                img_path = str(IMG_ORIG_DIR / image.path)
+                content_hash = await asyncio.to_thread(file_sha256, img_path)
+
+                known = image.known
+                if known is not None and known.status != "error" and known.content_hash == content_hash:
+                    await queue.put(FeederJob(image, content_hash, known.perceptual_hash, None, False))
+                    continue
+
+                p_hash = None
+                if self._perceptual_dedup:
+                    p_hash = await asyncio.to_thread(perceptual_hash, img_path)
+
+                if known is None and image.path in legacy_faces:
+                    await queue.put(FeederJob(image, content_hash, p_hash, None, False))
+                    continue
+
+                replace = known is not None
+                source = by_content.get(content_hash)
+                if source is None and p_hash is not None:
+                    source = by_perceptual.get(p_hash)
+                if source is not None:
+                    await queue.put(FeederJob(image, content_hash, p_hash, None, replace, source))
+                    continue
 
-        success_img_count = 0
+                by_content[content_hash] = image.path
+                if p_hash is not None:
+                    by_perceptual[p_hash] = image.path
 
-        all_fns_db = await self._face_repo.find_all_filenames()
+                future = self._submit(executor, img_path)
+                await queue.put(FeederJob(image, content_hash, p_hash, future, replace))
+            await queue.put(None)
 
-        new_files = []
-        for f in os.listdir(IMG_ORIG_DIR):
-            if (
-                f not in all_fns_db
-                and f.lower().endswith((".jpg", ".jpeg", ".png", ".webp"))
-                and os.path.isfile(os.path.join(IMG_ORIG_DIR, f))
-            ):
-                new_files.append(f)
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(produce())
+                writer = tg.create_task(
+                    self._write_results(queue, len(new_files), known_images, legacy_faces, send_msg)
+                )
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
 
-        for fn in new_files:
-            print(f"Processing {fn}")
+        await send_msg(f"Processed images: {writer.result()}")
 
-            for model in models:
+    @staticmethod
+    def _scan_changed_images(known_images: dict[str, ImageRecord]) -> list[ScannedImage]:
+        changed: list[ScannedImage] = []
+        with os.scandir(IMG_ORIG_DIR) as it:
+            for entry in it:
+                if not entry.name.lower().endswith((".jpg", ".jpeg", ".png", ".webp")) or not entry.is_file():
+                    continue
+
+                st = entry.stat()
+                known = known_images.get(entry.name)
+                if (
+                    known is not None
+                    and known.status != "error"
+                    and known.size == st.st_size
+                    and known.mtime_ns == st.st_mtime_ns
+                ):
+                    continue
+
+                changed.append(ScannedImage(entry.name, st.st_size, st.st_mtime_ns, known))
+
+        return changed
+
+    def _create_executor(self) -> ProcessPoolExecutor | None:
+        if self._workers <= 0:
+            return None
+        return ProcessPoolExecutor(
+            max_workers=self._workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self._detector_backend, self._max_detection_side, self._models),
+        )
+
+    def _submit(
+        self, executor: ProcessPoolExecutor | None, img_path: str
+    ) -> asyncio.Future[dict[str, FaceEmbeddingList]]:
+        loop = asyncio.get_running_loop()
+        if executor is not None:
+            return loop.run_in_executor(executor, _represent_in_worker, img_path, self._models)
+
+        # workers = 0, inference runs inline in this process
+        if _worker_engine is None:
+            _init_worker(self._detector_backend, self._max_detection_side, self._models)
+        future: asyncio.Future[dict[str, FaceEmbeddingList]] = loop.create_future()
+        try:
+            future.set_result(_represent_in_worker(img_path, self._models))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    async def _write_results(
+        self,
+        queue: asyncio.Queue[FeederJob | None],
+        total: int,
+        known_images: dict[str, ImageRecord],
+        legacy_faces: dict[str, int],
+        send_msg: Callable[[str], Awaitable[None]],
+    ) -> int:
+        batch = FaceRegionBatchWriter(
+            self._session, self._face_repo, self._image_repo, self._batch_size, self._flush_seconds
+        )
+        started_at = time.monotonic()
+        done_count = 0
+        success_count = 0
+        dedup_count = 0
+        outcomes: dict[str, ImageRecord] = {}
+
+        while True:
+            try:
+                # Wake up on the time limit even when no new results arrive
+                job = await asyncio.wait_for(queue.get(), timeout=batch.seconds_until_flush())
+            except TimeoutError:
+                await self._flush(batch)
+                continue
+
+            if job is None:
+                break
+
+            image = job.image
+            done_count += 1
+            record = partial(self._image_record, job)
+
+            if job.alias_of is not None:
+                source = outcomes.get(job.alias_of) or known_images.get(job.alias_of)
+                if source is None or source.status == "error":
+                    outcome = record("error", 0)
+                    batch.add(outcome, replace=job.replace)
+                else:
+                    outcome = record(source.status, source.face_count)
+                    batch.add(outcome, replace=job.replace, alias_of=job.alias_of)
+                    dedup_count += 1
+            elif job.result is None:
+                if image.known is not None:
+                    outcome = record(image.known.status, image.known.face_count)
+                else:
+                    outcome = record("faces", legacy_faces[image.path])
+                batch.add(outcome)
+            else:
                 try:
-                    faces_data = self._face_engine.represent_face(img_path=str(IMG_ORIG_DIR / fn))
-
-                    for data in faces_data:
-                        quality = 0.0
-                        if data.facial_area.w >= 30 and data.facial_area.h >= 30 and data.face_confidence >= 0.6:
-                            quality = 1.0
-
-                        face = FaceRegion(
-                            filename=fn,
-                            face_confidence=data.face_confidence,
-                            face_quality=quality,
-                            x=data.facial_area.x,
-                            y=data.facial_area.y,
-                            w=data.facial_area.w,
-                            h=data.facial_area.h,
-                            left_eye=list(map(int, data.facial_area.left_eye)),
-                            right_eye=list(map(int, data.facial_area.right_eye)),
-                            model=model,
-                            vector=np.array(data.embedding),
-                        )
-                        self._session.add(face)
-                        await self._session.commit()
-                    print(f"Done: {model}, found {faces_data.count} faces")
-
-                except ValueError:
-                    print(f"Error: {model}")
+                    faces_by_model = await job.result
+                except NoFaceFound:
+                    print(f"No face: {image.path}")
+                    outcome = record("no_face", 0)
+                    batch.add(outcome, replace=job.replace)
+                except (ValueError, OSError):
+                    # OSError covers files Pillow cannot decode
+                    print(f"Error: {image.path}")
+                    outcome = record("error", 0)
+                    batch.add(outcome, replace=job.replace)
+                else:
+                    faces = [
+                        self._create_face_region(image.path, model, data)
+                        for model, faces_data in faces_by_model.items()
+                        for data in faces_data
+                    ]
+                    face_count = max((faces_data.count for faces_data in faces_by_model.values()), default=0)
+                    outcome = record("faces", face_count)
+                    batch.add(outcome, faces, replace=job.replace)
+                    success_count += 1
+
+            outcomes[image.path] = outcome
+
+            if batch.should_flush():
+                await self._flush(batch)
 
+            if done_count % FEEDER_REPORT_EVERY == 0:
+                await send_msg(self._progress_msg(done_count, total, started_at, batch.written_count))
+
+        await self._flush(batch)
+        await send_msg(self._progress_msg(done_count, total, started_at, batch.written_count))
+        await send_msg(f"Duplicates reused without inference: {dedup_count}")
+        return success_count
+
+    async def _flush(self, batch: FaceRegionBatchWriter) -> None:
+        # New rows become searchable in the memory-mapped matrices right after their batch is committed, the
+        # replaced rows of re-ingested images are dropped from them at the same time
+        written = await batch.flush()
+        if (written or batch.deleted_ids) and self._vector_search_backend == "mmap":
+            for model, ids in batch.deleted_ids.items():
+                self._vector_store.delete(str_to_model_type(model), ids)
+            for model in self._models:
+                await self._vector_store.sync(self._session, model)
+            # Ends the read transaction of the sync, it would otherwise stay open until the next batch
             await self._session.commit()
 
-            success_img_count += 1
+    @staticmethod
+    def _progress_msg(done_count: int, total: int, started_at: float, face_count: int) -> str:
+        elapsed = time.monotonic() - started_at
+        rate = done_count / elapsed if elapsed > 0 else 0.0
+        return f"Progress: {done_count}/{total}, {rate:.2f} images/sec, {face_count} faces"
+
+    @staticmethod
+    def _image_record(job: FeederJob, status: IngestStatus, face_count: int) -> ImageRecord:
+        image = job.image
+        return ImageRecord(
+            image.path, image.size, image.mtime_ns, job.content_hash, job.perceptual_hash, status, face_count
+        )
+
+    @staticmethod
+    def _create_face_region(fn: str, model: str, data: FaceEmbedding) -> FaceRegion:
+        quality = 0.0
+        if data.facial_area.w >= 30 and data.facial_area.h >= 30 and data.face_confidence >= 0.6:
+            quality = 1.0
 
-        print(f"Processed images: {success_img_count}")
+        return FaceRegion(
+            filename=fn,
+            face_confidence=data.face_confidence,
+            face_quality=quality,
+            x=data.facial_area.x,
+            y=data.facial_area.y,
+            w=data.facial_area.w,
+            h=data.facial_area.h,
+            left_eye=list(map(int, data.facial_area.left_eye)),
+            right_eye=list(map(int, data.facial_area.right_eye)),
+            model=model,
+            vector=np.array(data.embedding),
+        )
@@ -1,6 +1,12 @@
+import io
+import math
 import os
 
-from PIL import Image
+import numpy as np
+from PIL import ExifTags, Image, ImageOps
+
+# EXIF orientations that swap width and height once applied
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
 
 
 def crop_and_save(image_path: str, x: int, y: int, w: int, h: int, output_path: str, overwrite: bool) -> str:
@@ -16,3 +22,47 @@ def crop_and_save(image_path: str, x: int, y: int, w: int, h: int, output_path:
     cropped_img.save(output_path)
 
     return output_path
+
+
+def perceptual_hash(image_path: str, hash_size: int = 8) -> str:
+    # Difference hash prefixed with the original size, equal values are only produced by images with equal face boxes
+    with Image.open(image_path) as img:
+        width, height = img.size
+        img.draft("L", (hash_size * 8, hash_size * 8))
+        gray = img.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+
+    pixels = np.asarray(gray, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return f"{width}x{height}:{np.packbits(bits).tobytes().hex()}"
+
+
+def load_image(source: str | bytes, max_side: int = 0) -> tuple[np.ndarray, float]:
+    # Decodes a file or an upload straight into the BGR array DeepFace expects, returns it with the applied scale
+    with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as img:
+        width, height = img.size
+        if img.getexif().get(ExifTags.Base.Orientation) in TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+
+        scale = 1.0
+        if max_side > 0 and max(width, height) > max_side:
+            scale = max_side / max(width, height)
+            # JPEG is decoded at a reduced DCT scale right away, the exact size is reached by the resize below
+            img.draft("RGB", (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+
+        rgb = ImageOps.exif_transpose(img).convert("RGB")
+        if scale < 1.0:
+            rgb = rgb.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.Resampling.BILINEAR)
+
+    return np.ascontiguousarray(np.asarray(rgb)[:, :, ::-1]), scale
+
+
+def downscale_image(img: np.ndarray, max_side: int) -> tuple[np.ndarray, float]:
+    height, width = img.shape[:2]
+    if max_side <= 0 or max(width, height) <= max_side:
+        return img, 1.0
+
+    scale = max_side / max(width, height)
+    resized = Image.fromarray(img).resize(
+        (max(1, round(width * scale)), max(1, round(height * scale))), Image.Resampling.BILINEAR
+    )
+    return np.asarray(resized), scale
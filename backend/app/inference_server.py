@@ -0,0 +1,99 @@
+import asyncio
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, File, Form, HTTPException, Request, Response, UploadFile
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+from app.app_config import (
+    APP_TITLE,
+    DETECTOR_BACKEND,
+    INFERENCE_CONCURRENCY,
+    INFERENCE_MAX_BATCH_SIZE,
+    INFERENCE_MAX_BATCH_WAIT_MS,
+    INFERENCE_QUEUE_TIMEOUT,
+    MAX_DETECTION_SIDE,
+    MODEL_DEFAULT,
+)
+from app.face_model_invoker import (
+    NO_FACE_ERROR,
+    ExecutorFaceModel,
+    FaceModelRegistry,
+    InferenceOverloaded,
+    LocalFaceModel,
+    NoFaceFound,
+    RemoteBatchResponse,
+    RemoteFaceResult,
+)
+
+# Inference node for INFERENCE_BACKEND=remote, serves the local models without the database:
+# uvicorn app.inference_server:app --port 8002
+# As a sidecar shared by all web workers of one machine, with INFERENCE_REMOTE_URLS=unix:/tmp/spylab-inference.sock:
+# uvicorn app.inference_server:app --uds /tmp/spylab-inference.sock
+
+registry = FaceModelRegistry(detector_backend=DETECTOR_BACKEND)
+face_engine = ExecutorFaceModel(
+    face_engine=LocalFaceModel(registry=registry, model_name=MODEL_DEFAULT, max_detection_side=MAX_DETECTION_SIDE),
+    registry=registry,
+    concurrency=INFERENCE_CONCURRENCY,
+    queue_timeout=INFERENCE_QUEUE_TIMEOUT,
+    max_batch_size=INFERENCE_MAX_BATCH_SIZE,
+    max_batch_wait_ms=INFERENCE_MAX_BATCH_WAIT_MS,
+)
+
+
+class ReadyResponse(BaseModel):
+    ready: bool
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncGenerator[None]:
+    app.state.model_warmup = registry.start_warm_up([MODEL_DEFAULT])
+    yield
+
+
+async def represent(contents: bytes) -> RemoteFaceResult:
+    try:
+        faces = await face_engine.represent_face(contents)
+    except NoFaceFound:
+        return RemoteFaceResult(error=NO_FACE_ERROR)
+    except (ValueError, OSError) as e:
+        return RemoteFaceResult(error=str(e) or "Image could not be processed")
+    return RemoteFaceResult(faces=faces.faces)
+
+
+def create_app() -> FastAPI:
+    app = FastAPI(title=f"{APP_TITLE} inference", lifespan=lifespan)
+
+    @app.get("/api/ready", response_model=ReadyResponse)
+    async def ready(response: Response) -> ReadyResponse:
+        if not registry.ready:
+            response.status_code = 503
+        return ReadyResponse(ready=registry.ready)
+
+    @app.post("/api/represent-batch", response_model=RemoteBatchResponse)
+    async def represent_batch(
+        files: list[UploadFile] = File(...),
+        detector_backend: str = Form(...),
+        model_name: str = Form(...),
+    ) -> RemoteBatchResponse:
+        if detector_backend != DETECTOR_BACKEND or model_name != MODEL_DEFAULT:
+            raise HTTPException(status_code=400, detail=f"This node serves {MODEL_DEFAULT} with {DETECTOR_BACKEND}")
+
+        # Images of one batch share the slots and the embedding batches with every other request
+        contents = [await file.read() for file in files]
+        return RemoteBatchResponse(results=await asyncio.gather(*(represent(item) for item in contents)))
+
+    @app.exception_handler(InferenceOverloaded)
+    async def inference_overloaded_handler(request: Request, exc: InferenceOverloaded):
+        return JSONResponse(
+            status_code=503,
+            headers={"Retry-After": "5"},
+            content={"message": str(exc), "statusCode": 503},
+        )
+
+    return app
+
+
+app = create_app()
@@ -0,0 +1,36 @@
+from datetime import UTC, datetime
+from typing import Literal, NamedTuple
+
+from sqlalchemy import BigInteger, DateTime, Integer, String
+from sqlalchemy.orm import Mapped, mapped_column
+
+from app.db import Base
+
+IngestStatus = Literal["faces", "no_face", "error"]
+
+
+class IngestedImage(Base):
+    __tablename__ = "ingested_image"
+
+    path: Mapped[str] = mapped_column(String(250), primary_key=True)
+    size: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    mtime_ns: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    content_hash: Mapped[str] = mapped_column(String(64), nullable=False, index=True)
+    perceptual_hash: Mapped[str | None] = mapped_column(String(48), nullable=True, index=True)
+    status: Mapped[str] = mapped_column(String(16), nullable=False)
+    face_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        default=lambda: datetime.now(UTC),
+        nullable=False,
+    )
+
+
+class ImageRecord(NamedTuple):
+    path: str
+    size: int
+    mtime_ns: int
+    content_hash: str
+    perceptual_hash: str | None
+    status: IngestStatus
+    face_count: int
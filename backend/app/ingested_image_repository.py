@@ -0,0 +1,52 @@
+from collections.abc import Sequence
+from datetime import UTC, datetime
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from wireup import service
+
+from app.ingested_image import ImageRecord, IngestedImage
+
+UPSERT_CHUNK_SIZE = 1000
+
+
+@service(lifetime="scoped")
+class IngestedImageRepository:
+    def __init__(self, session: AsyncSession):
+        self._session = session
+
+    async def find_all_records(self) -> dict[str, ImageRecord]:
+        q = select(
+            IngestedImage.path,
+            IngestedImage.size,
+            IngestedImage.mtime_ns,
+            IngestedImage.content_hash,
+            IngestedImage.perceptual_hash,
+            IngestedImage.status,
+            IngestedImage.face_count,
+        )
+        result = await self._session.stream(q.execution_options(yield_per=10_000))
+        return {row.path: ImageRecord(*row) async for row in result}
+
+    async def upsert(self, records: Sequence[ImageRecord]) -> None:
+        if not records:
+            return
+
+        now = datetime.now(UTC)
+        for i in range(0, len(records), UPSERT_CHUNK_SIZE):
+            chunk = records[i : i + UPSERT_CHUNK_SIZE]
+            stmt = insert(IngestedImage).values([{**record._asdict(), "updated_at": now} for record in chunk])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[IngestedImage.path],
+                set_={
+                    "size": stmt.excluded.size,
+                    "mtime_ns": stmt.excluded.mtime_ns,
+                    "content_hash": stmt.excluded.content_hash,
+                    "perceptual_hash": stmt.excluded.perceptual_hash,
+                    "status": stmt.excluded.status,
+                    "face_count": stmt.excluded.face_count,
+                    "updated_at": stmt.excluded.updated_at,
+                },
+            )
+            await self._session.execute(stmt)
@@ -1,3 +1,6 @@
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+
 import wireup.integration.fastapi
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
@@ -13,14 +16,31 @@ from app.app_config import (
     IMG_ORIG_DIR_URL_PATH,
     IMG_TEMP_DIR,
     IMG_TEMP_DIR_URL_PATH,
+    INFERENCE_BACKEND,
+    MODEL_DEFAULT,
+    MODEL_WARMUP,
 )
 from app.container import container
+from app.db import SearchPool
+from app.face_model_invoker import FaceModelRegistry, InferenceOverloaded, RemoteFaceModel
 from app.gql_schema import get_context, schema
 from app.router import router
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncGenerator[None]:
+    if MODEL_WARMUP and INFERENCE_BACKEND == "local":
+        # Runs in the background, /api/ready reports 503 until the models are loaded
+        registry = await container.get(FaceModelRegistry)
+        app.state.model_warmup = registry.start_warm_up([MODEL_DEFAULT])
+    yield
+    if INFERENCE_BACKEND == "remote":
+        await (await container.get(RemoteFaceModel)).aclose()
+    await (await container.get(SearchPool)).aclose()
+
+
 def create_app() -> FastAPI:
-    app = FastAPI(title=APP_TITLE)
+    app = FastAPI(title=APP_TITLE, lifespan=lifespan)
     app.mount(IMG_TEMP_DIR_URL_PATH, StaticFiles(directory=IMG_TEMP_DIR), name="preview")
     app.mount(IMG_ORIG_DIR_URL_PATH, StaticFiles(directory=IMG_ORIG_DIR), name="original")
 
@@ -45,6 +65,17 @@ def create_app() -> FastAPI:
             },
         )
 
+    @app.exception_handler(InferenceOverloaded)
+    async def inference_overloaded_handler(request: Request, exc: InferenceOverloaded):
+        return JSONResponse(
+            status_code=503,
+            headers={"Retry-After": "5"},
+            content={
+                "message": "Face recognition is busy, please try again later",
+                "statusCode": 503,
+            },
+        )
+
     @app.exception_handler(Exception)
     async def generic_exception_handler(request: Request, exc: Exception):
         return JSONResponse(
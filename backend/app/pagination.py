@@ -0,0 +1,31 @@
+import base64
+import binascii
+import json
+from typing import Any
+
+from fastapi import Response
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(*values: float) -> str:
+    # Opaque to clients, the sort key of the last row of a page
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, *types: type[float] | type[int]) -> tuple[Any, ...]:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return tuple(cast(value) for cast, value in zip(types, values, strict=True))
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError) as e:
+        raise InvalidCursor("Invalid cursor") from e
+
+
+def append_cursor_header(response: Response, next_cursor: str | None) -> None:
+    # No header on the last page
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    exposed = [h for h in response.headers.get("Access-Control-Expose-Headers", "").split(", ") if h]
+    response.headers["Access-Control-Expose-Headers"] = ", ".join([*exposed, "X-Next-Cursor"])
@@ -1,16 +1,19 @@
 from typing import Literal
 
-from fastapi import APIRouter, Depends, File, Form, HTTPException, Request, Response, UploadFile
+from fastapi import APIRouter, Depends, File, Form, HTTPException, Query, Request, Response, UploadFile
 from fastapi import status as statusList
-from pydantic import BaseModel, EmailStr, NonNegativeInt
+from pydantic import BaseModel, EmailStr, Field, NonNegativeInt, PositiveInt
 from wireup import Injected
 
 from app import face_service
-from app.app_config import ACCESS_TOKEN_COOKIE_NAME
+from app.app_config import ACCESS_TOKEN_COOKIE_NAME, MAX_BATCH_QUERIES, MAX_PAGE_SIZE, PAGE_SIZE
 from app.auth_service import AuthService, TokenPayload, fastapi_require_access_token
 from app.dashboard_service import DashboardService, DashStats
-from app.face_model_invoker import NoFaceFound
+from app.db import PoolStats, SearchPool, pool_stats
+from app.face_model_invoker import AsyncFaceModelInterface, InferenceStats, NoFaceFound
 from app.face_service import AnalyzeBox, FaceItem, FaceService, FaceSimilarItem
+from app.pagination import InvalidCursor, append_cursor_header
+from app.upload_cache import UploadNotCached
 from app.user_repository import UserRepository
 
 """
@@ -74,10 +77,21 @@ async def read_random(
     response: Response,
     face_service: Injected[FaceService],
     search: str = "",
-    limit: int = 20,
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    # "id" pages through all faces with the X-Next-Cursor header, "random" is a fresh sample on every call
+    sort: Literal["random", "id"] = "random",
+    cursor: str | None = None,
     jwt: TokenPayload = Depends(fastapi_require_access_token),
 ) -> list[FaceItemResponse]:
-    res = await face_service.find_list(limit, search)
+    if sort == "id":
+        try:
+            page = await face_service.find_page(limit, search, cursor)
+        except InvalidCursor as e:
+            raise HTTPException(status_code=statusList.HTTP_400_BAD_REQUEST, detail=str(e))
+        append_cursor_header(response, page.next_cursor)
+        res = page.items
+    else:
+        res = await face_service.find_list(limit, search)
     return [
         FaceItemResponse(
             **item.model_dump(),
@@ -109,6 +123,7 @@ class ImageData(BaseModel):
 class UploadImageResponse(BaseModel):
     preview_url: str
     source_url: str
+    handle: str
     boxes: list[AnalyzeBox]
 
 
@@ -123,7 +138,8 @@ async def analyze_image(
         data = await face_service.analyze_image(file)
 
         return UploadImageResponse(
-            boxes=data,
+            handle=data.handle,
+            boxes=data.boxes,
             preview_url=f"{str(request.base_url)}preview/",
             source_url=f"{str(request.base_url)}source_img/",
         )
@@ -136,12 +152,23 @@ async def analyze_image(
 async def find_similar_id(
     request: Request,
     face_service: Injected[FaceService],
+    response: Response,
     id: int,
     model: str,
     metric: str = "cosine",
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
     jwt: TokenPayload = Depends(fastapi_require_access_token),
 ) -> list[FaceSimilarItemResponse]:
-    res = await face_service.find_similar_by_face_id(id=id, model=model, metric=metric, limit=50, quality=None)
+    try:
+        page = await face_service.find_similar_by_face_id(
+            id=id, model=model, metric=metric, limit=limit, cursor=cursor, quality=None
+        )
+    except InvalidCursor as e:
+        raise HTTPException(status_code=statusList.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    append_cursor_header(response, page.next_cursor)
+    res = page.items
 
     return [
         FaceSimilarItemResponse(
@@ -157,18 +184,34 @@ async def find_similar_id(
 async def find_similar_image(
     request: Request,
     response: Response,
-    image: UploadFile,
     face_service: Injected[FaceService],
+    image: UploadFile | None = File(None),
+    handle: str | None = Form(None),
     x: int = Form(...),
     y: int = Form(...),
     w: int = Form(...),
     h: int = Form(...),
     quality: int | None = Form(None),
+    # The UIs read a single page, 100 as before the cursor pagination
+    limit: int = Form(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = Form(None),
     jwt: TokenPayload = Depends(fastapi_require_access_token),
 ) -> list[FaceSimilarItemResponse]:
-    res = await face_service.find_similar_by_image(file=image, x=x, y=y, w=w, h=h, limit=100, offset=0, quality=quality)
+    if image is None and handle is None:
+        raise HTTPException(status_code=statusList.HTTP_400_BAD_REQUEST, detail="Send the image or its handle")
 
+    try:
+        page = await face_service.find_similar_by_image(
+            file=image, handle=handle, x=x, y=y, w=w, h=h, limit=limit, cursor=cursor, quality=quality
+        )
+    except UploadNotCached as e:
+        raise HTTPException(status_code=statusList.HTTP_410_GONE, detail=str(e))
+    except InvalidCursor as e:
+        raise HTTPException(status_code=statusList.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    res = page.items
     append_pagination_headers(response, len(res))
+    append_cursor_header(response, page.next_cursor)
 
     return [
         FaceSimilarItemResponse(
@@ -180,6 +223,74 @@ async def find_similar_image(
     ]
 
 
+class SimilarBatchRequest(BaseModel):
+    ids: list[PositiveInt] = Field(min_length=1, max_length=MAX_BATCH_QUERIES)
+    model: str
+    metric: str = "cosine"
+    limit: int = Field(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
+    quality: int | None = None
+
+
+class SimilarBatchItem(BaseModel):
+    id: int
+    items: list[FaceSimilarItemResponse]
+
+
+@router.post("/similar-batch", response_model=list[SimilarBatchItem])
+async def find_similar_batch(
+    request: Request,
+    face_service: Injected[FaceService],
+    body: SimilarBatchRequest,
+    jwt: TokenPayload = Depends(fastapi_require_access_token),
+) -> list[SimilarBatchItem]:
+    # Top matches of many faces at once, unknown ids are left out
+    results = await face_service.find_similar_by_face_ids(
+        ids=body.ids, model=body.model, metric=body.metric, limit=body.limit, quality=body.quality
+    )
+
+    return [
+        SimilarBatchItem(
+            id=face_id,
+            items=[
+                FaceSimilarItemResponse(
+                    **item.model_dump(),
+                    preview_url=f"{str(request.base_url)}preview/{item.preview_path}",
+                    source_url=f"{str(request.base_url)}source_img/{item.source_filepath}",
+                )
+                for item in items
+            ],
+        )
+        for face_id, items in results.items()
+    ]
+
+
+class ReadyResponse(BaseModel):
+    ready: bool
+
+
+@router.get("/ready", response_model=ReadyResponse)
+async def ready(response: Response, face_model: Injected[AsyncFaceModelInterface]) -> ReadyResponse:
+    if not face_model.ready:
+        response.status_code = statusList.HTTP_503_SERVICE_UNAVAILABLE
+    return ReadyResponse(ready=face_model.ready)
+
+
+@router.get("/inference-stats", response_model=InferenceStats)
+async def inference_stats(
+    face_model: Injected[AsyncFaceModelInterface],
+    jwt: TokenPayload = Depends(fastapi_require_access_token),
+) -> InferenceStats:
+    return face_model.stats()
+
+
+@router.get("/db-stats", response_model=list[PoolStats])
+async def db_stats(
+    search_pool: Injected[SearchPool],
+    jwt: TokenPayload = Depends(fastapi_require_access_token),
+) -> list[PoolStats]:
+    return [*pool_stats(), *search_pool.stats()]
+
+
 @router.get("/dashboard", response_model=DashStats)
 async def dashboard(
     dashboard_service: Injected[DashboardService],
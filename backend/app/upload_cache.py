@@ -0,0 +1,58 @@
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Annotated
+
+from wireup import Inject, service
+
+from app.face_model_invoker import FaceEmbeddingList
+
+
+class UploadNotCached(Exception):
+    pass
+
+
+@service(lifetime="singleton")
+class UploadEmbeddingCache:
+    # Faces of recent uploads keyed by content hash, so follow-up searches on the same image skip inference
+    def __init__(
+        self,
+        max_entries: Annotated[int, Inject(param="upload_cache_size")],
+        ttl: Annotated[float, Inject(param="upload_cache_ttl")],
+    ):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, FaceEmbeddingList]] = OrderedDict()
+
+    @staticmethod
+    def key(contents: bytes) -> str:
+        return hashlib.sha256(contents).hexdigest()
+
+    def get(self, key: str) -> FaceEmbeddingList | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, faces = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return faces
+
+    def put(self, key: str, faces: FaceEmbeddingList) -> None:
+        if self._max_entries <= 0:
+            return
+
+        self._entries[key] = (time.monotonic() + self._ttl, faces)
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        while self._entries:
+            key, (expires_at, _) = next(iter(self._entries.items()))
+            if len(self._entries) <= self._max_entries and expires_at > now:
+                break
+            del self._entries[key]
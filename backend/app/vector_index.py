@@ -0,0 +1,216 @@
+import asyncio
+import math
+import re
+import time
+from collections.abc import AsyncGenerator, Awaitable, Callable
+from contextlib import asynccontextmanager
+from typing import Annotated, Any, Literal, NamedTuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+from wireup import Inject, service
+
+from app.app_config import MODEL_VECTOR_SIZES
+from app.db import engine
+from app.face_region import FaceRegion
+from app.helpers import ModelType, QuantizationType
+
+IndexMethod = Literal["hnsw", "ivfflat"]
+
+# Dimensions pgvector can index per representation, quantized codes are indexed as expressions of the full vector
+MAX_INDEX_DIMENSIONS: dict[str, int] = {"none": 2000, "halfvec": 4000, "binary": 64000}
+# Embeddings are stored normalized and the indexes order them by inner product. Cosine searches are served by the
+# index directly, L2 searches re-rank its nearest candidates by their exact distance. Sign bits are compared by
+# Hamming distance
+OPERATOR_CLASSES: dict[str, str] = {"none": "vector_ip_ops", "halfvec": "halfvec_ip_ops", "binary": "bit_hamming_ops"}
+PROGRESS_SECONDS = 5.0
+
+INDEX_STATE_SQL = text(
+    "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+)
+PROGRESS_SQL = text(
+    "SELECT phase, blocks_done, blocks_total, tuples_done, tuples_total "
+    "FROM pg_stat_progress_create_index WHERE relid = CAST(:table AS regclass)"
+)
+LIST_SQL = text(
+    "SELECT c.relname AS name, am.amname AS method, i.indisvalid AS valid, "
+    "pg_relation_size(c.oid) AS size_bytes, pg_get_indexdef(c.oid) AS definition "
+    "FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid JOIN pg_am am ON am.oid = c.relam "
+    "WHERE i.indrelid = CAST(:table AS regclass) AND am.amname IN ('hnsw', 'ivfflat') ORDER BY c.relname"
+)
+
+
+class VectorIndexInfo(NamedTuple):
+    name: str
+    method: str
+    valid: bool
+    size_bytes: int
+    definition: str
+
+
+async def print_progress(msg: str) -> None:
+    print(msg)
+
+
+@service(lifetime="singleton")
+class VectorIndexManager:
+    def __init__(
+        self,
+        hnsw_m: Annotated[int, Inject(param="hnsw_m")],
+        hnsw_ef_construction: Annotated[int, Inject(param="hnsw_ef_construction")],
+        maintenance_work_mem: Annotated[str, Inject(param="vector_index_maintenance_work_mem")],
+    ):
+        self._hnsw_m = hnsw_m
+        self._hnsw_ef_construction = hnsw_ef_construction
+        self._maintenance_work_mem = maintenance_work_mem
+
+    @staticmethod
+    def index_expression(model: ModelType, quantization: QuantizationType = "none") -> str:
+        dimensions = MODEL_VECTOR_SIZES[model]
+        if quantization not in MAX_INDEX_DIMENSIONS:
+            raise ValueError(f"pgvector has no {quantization} vectors, {quantization} codes need the mmap backend")
+        if dimensions > MAX_INDEX_DIMENSIONS[quantization]:
+            raise ValueError(
+                f"{model} has {dimensions} dimensions, pgvector indexes {quantization} vectors "
+                f"of up to {MAX_INDEX_DIMENSIONS[quantization]}"
+            )
+
+        # Must match FaceRepository._candidate_distance, expression indexes only serve the very same expression
+        column = f"emb_{dimensions}"
+        if quantization == "halfvec":
+            return f"({column}::halfvec({dimensions}))"
+        elif quantization == "binary":
+            return f"(binary_quantize({column})::bit({dimensions}))"
+        return column
+
+    @classmethod
+    def index_name(cls, model: ModelType, method: IndexMethod, quantization: QuantizationType = "none") -> str:
+        cls.index_expression(model, quantization)
+        model_slug = re.sub(r"[^a-z0-9]+", "_", model.lower())
+        variant = {"none": "ip", "halfvec": "halfvec_ip", "binary": "binary"}[quantization]
+        return f"ix_{FaceRegion.__tablename__}_emb_{MODEL_VECTOR_SIZES[model]}_{model_slug}_{variant}_{method}"
+
+    async def create_index(
+        self,
+        model: ModelType,
+        method: IndexMethod,
+        quantization: QuantizationType = "none",
+        rebuild: bool = False,
+        lists: int | None = None,
+        progress_cb: Callable[[str], Awaitable[None]] = print_progress,
+    ) -> str:
+        name = self.index_name(model, method, quantization)
+
+        async with self._autocommit() as conn:
+            valid = await self._index_state(conn, name)
+            if valid is True and not rebuild:
+                await progress_cb(f"{name} already exists")
+                return name
+            if valid is False:
+                # Leftover of an interrupted concurrent build, it is not used by queries but still updated on writes
+                await conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"'))
+
+            # A rebuild creates the new index next to the old one, searches keep using the old one until the swap
+            target = f"{name}_rebuild" if valid is True else name
+            if target != name:
+                await conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{target}"'))
+
+            if method == "ivfflat" and lists is None:
+                lists = await self._default_lists(conn, model)
+            ddl = self._create_sql(target, model, method, quantization, lists)
+            await progress_cb(f"Building {name}: {ddl}")
+
+            await conn.execute(text(f"SET maintenance_work_mem = '{self._maintenance_work_mem}'"))
+            try:
+                await self._build(conn, ddl, name, progress_cb)
+            finally:
+                await conn.execute(text("RESET maintenance_work_mem"))
+
+        if target != name:
+            async with engine.begin() as swap:
+                await swap.execute(text(f'DROP INDEX "{name}"'))
+                await swap.execute(text(f'ALTER INDEX "{target}" RENAME TO "{name}"'))
+
+        return name
+
+    async def drop_index(self, model: ModelType, method: IndexMethod, quantization: QuantizationType = "none") -> str:
+        name = self.index_name(model, method, quantization)
+        async with self._autocommit() as conn:
+            await conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"'))
+        return name
+
+    async def list_indexes(self) -> list[VectorIndexInfo]:
+        async with self._autocommit() as conn:
+            result = await conn.execute(LIST_SQL, {"table": FaceRegion.__tablename__})
+            return [VectorIndexInfo(*row) for row in result.all()]
+
+    def _create_sql(
+        self,
+        name: str,
+        model: ModelType,
+        method: IndexMethod,
+        quantization: QuantizationType,
+        lists: int | None,
+    ) -> str:
+        if model not in MODEL_VECTOR_SIZES:
+            raise ValueError(f"Model '{model}' is not supported.")
+
+        if method == "hnsw":
+            options = f"m = {int(self._hnsw_m)}, ef_construction = {int(self._hnsw_ef_construction)}"
+        else:
+            options = f"lists = {int(lists or 1)}"
+
+        # Partial index per model, every model shares the column but is searched on its own
+        return (
+            f'CREATE INDEX CONCURRENTLY "{name}" ON {FaceRegion.__tablename__} '
+            f"USING {method} ({self.index_expression(model, quantization)} {OPERATOR_CLASSES[quantization]}) "
+            f"WITH ({options}) WHERE model = '{model}'"
+        )
+
+    async def _build(
+        self, conn: AsyncConnection, ddl: str, name: str, progress_cb: Callable[[str], Awaitable[None]]
+    ) -> None:
+        started_at = time.monotonic()
+        build = asyncio.create_task(conn.execute(text(ddl)))
+
+        async with self._autocommit() as monitor:
+            while not build.done():
+                await asyncio.wait({build}, timeout=PROGRESS_SECONDS)
+                if build.done():
+                    break
+                row = (await monitor.execute(PROGRESS_SQL, {"table": FaceRegion.__tablename__})).first()
+                if row is not None:
+                    await progress_cb(self._progress_msg(name, row, started_at))
+
+        await build
+        await progress_cb(f"{name} built in {time.monotonic() - started_at:.0f}s")
+
+    @staticmethod
+    def _progress_msg(name: str, row: Any, started_at: float) -> str:
+        msg = f"{name}: {row.phase}"
+        if row.tuples_total:
+            msg += f", tuples {row.tuples_done}/{row.tuples_total} ({row.tuples_done / row.tuples_total:.0%})"
+        elif row.blocks_total:
+            msg += f", blocks {row.blocks_done}/{row.blocks_total} ({row.blocks_done / row.blocks_total:.0%})"
+        return f"{msg}, {time.monotonic() - started_at:.0f}s"
+
+    @staticmethod
+    async def _index_state(conn: AsyncConnection, name: str) -> bool | None:
+        return (await conn.execute(INDEX_STATE_SQL, {"name": name})).scalar_one_or_none()
+
+    @staticmethod
+    async def _default_lists(conn: AsyncConnection, model: ModelType) -> int:
+        # pgvector guidance: rows / 1000 up to a million rows, sqrt(rows) above
+        count = (
+            await conn.execute(
+                text(f"SELECT count(*) FROM {FaceRegion.__tablename__} WHERE model = :model"), {"model": model}
+            )
+        ).scalar_one()
+        return max(1, count // 1000 if count <= 1_000_000 else int(math.sqrt(count)))
+
+    @staticmethod
+    @asynccontextmanager
+    async def _autocommit() -> AsyncGenerator[AsyncConnection]:
+        # Concurrent index builds cannot run inside a transaction, progress views are only fresh outside one
+        async with engine.connect() as conn:
+            yield await conn.execution_options(isolation_level="AUTOCOMMIT")
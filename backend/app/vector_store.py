@@ -0,0 +1,376 @@
+import json
+import os
+import re
+import time
+from collections.abc import Callable, Sequence
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Annotated, Any, NamedTuple
+
+import numpy as np
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.orm import InstrumentedAttribute
+from wireup import Inject, service
+
+from app.app_config import MODEL_VECTOR_SIZES
+from app.face_region import FaceRegion
+from app.helpers import MetricType, ModelType, QuantizationType, str_to_quantization_type
+
+SYNC_BATCH_ROWS = 10_000
+SEARCH_BLOCK_ROWS = 65_536
+INT8_MAX = 127
+# Rows deleted from the mapped files before a sync rebuilds them
+MAX_DELETED_SHARE = 0.5
+# Compact codes searched before the exact re-ranking, binary codes are packed sign bits
+CODE_TYPES: dict[str, type[np.generic]] = {"halfvec": np.float16, "int8": np.int8, "binary": np.uint8}
+
+
+class VectorStoreMissing(Exception):
+    pass
+
+
+class VectorMatrix(NamedTuple):
+    vectors: np.ndarray
+    norms: np.ndarray
+    quality: np.ndarray
+    ids: np.ndarray
+    codes: np.ndarray | None
+    # Per-row dequantization factors of int8 codes
+    scales: np.ndarray | None
+    # False for the rows deleted since the build, None without deletions
+    live: np.ndarray | None
+    quantization: QuantizationType
+    version: tuple[int, int]
+
+
+@service(lifetime="singleton")
+class MmapVectorStore:
+    # Embeddings of every model in memory-mapped files, processes on one machine share them through the page cache
+    def __init__(
+        self,
+        directory: Annotated[Path, Inject(param="vector_store_dir")],
+        quantization: Annotated[str, Inject(param="vector_quantization")],
+        rerank_depth: Annotated[int, Inject(param="vector_rerank_depth")],
+    ):
+        self._directory = directory
+        self._quantization = str_to_quantization_type(quantization)
+        self._rerank_depth = rerank_depth
+        self._matrices: dict[str, VectorMatrix] = {}
+
+    def search(
+        self,
+        model: ModelType,
+        target_vector: np.ndarray,
+        metric: MetricType,
+        limit: int,
+        offset: int = 0,
+        quality: int | None = None,
+        max_distance: float | None = None,
+        after: tuple[float, int] | None = None,
+    ) -> list[tuple[int, float]]:
+        matrix = self._load(model)
+        k = offset + limit
+        if k <= 0 or not len(matrix.ids):
+            return []
+
+        query = np.asarray(target_vector, dtype=np.float32)
+        query_norm = float(np.linalg.norm(query))
+        unit_query = query / query_norm if query_norm else query
+
+        def exact(rows: slice | np.ndarray) -> np.ndarray:
+            return self._distances(matrix.vectors[rows] @ unit_query, matrix.norms[rows], query_norm, metric)
+
+        if matrix.codes is None:
+            rows, distances = self._scan(matrix, exact, k, quality, max_distance, after)
+        else:
+            # Candidates come from the compact codes, only their rows of the full vectors are read for the re-ranking
+            approximate = self._code_distances(matrix, unit_query, query_norm, metric)
+            depth = max(k, self._rerank_depth)
+            while True:
+                rows, _ = self._scan(matrix, approximate, depth, quality, None)
+                rows = np.sort(rows)
+                distances = exact(rows)
+                if max_distance is not None:
+                    distances[distances > max_distance] = np.inf
+                if after is not None:
+                    distances[self._before(distances, matrix.ids[rows], after)] = np.inf
+                # Later pages widen the candidates until enough of them are past the cursor
+                if after is None or len(rows) < depth or np.isfinite(distances).sum() >= k:
+                    break
+                depth *= 2
+
+        order = np.lexsort((matrix.ids[rows], distances))
+        order = order[np.isfinite(distances[order])][offset:k]
+        return [(int(matrix.ids[rows[i]]), float(distances[i])) for i in order]
+
+    def count_similar(
+        self,
+        model: ModelType,
+        target_vector: np.ndarray,
+        metric: MetricType,
+        max_distance: float,
+        limit: int,
+        quality: int | None = None,
+    ) -> int:
+        return len(self.search(model, target_vector, metric, limit, quality=quality, max_distance=max_distance))
+
+    async def sync(self, session: AsyncSession, model: ModelType) -> int:
+        # Appends rows inserted since the last sync, readers see them once the metadata file is replaced
+        meta = self._read_meta(model)
+        if meta is None or meta.get("quantization", "none") != self._quantization:
+            return await self.rebuild(session, model)
+        if meta.get("deleted", 0) > meta["count"] * MAX_DELETED_SHARE:
+            return await self.rebuild(session, model)
+
+        added = await self._append_rows(session, model, meta)
+        if added:
+            self._write_meta(model, meta)
+        return added
+
+    def delete(self, model: ModelType, ids: Sequence[int]) -> int:
+        # Tombstones for rows deleted from the table, searches skip them until a rebuild drops them from the files
+        meta = self._read_meta(model)
+        if meta is None:
+            return 0
+        deleted = np.array([face_id for face_id in ids if face_id <= meta["max_id"]], dtype=np.int64)
+        if not len(deleted):
+            return 0
+
+        deleted_count = meta.get("deleted", 0)
+        with open(self._array_path(model, meta, "deleted"), "ab") as f:
+            f.truncate(deleted_count * np.dtype(np.int64).itemsize)
+            f.write(deleted.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        meta["deleted"] = deleted_count + len(deleted)
+        self._write_meta(model, meta)
+        return len(deleted)
+
+    async def rebuild(self, session: AsyncSession, model: ModelType) -> int:
+        # A new generation of files, readers keep their mappings of the old one until they notice the switch
+        previous = self._read_meta(model)
+        meta = {
+            "generation": time.time_ns(),
+            "dim": MODEL_VECTOR_SIZES[model],
+            "quantization": self._quantization,
+            "count": 0,
+            "max_id": 0,
+            "deleted": 0,
+        }
+        self._model_dir(model).mkdir(parents=True, exist_ok=True)
+        await self._append_rows(session, model, meta)
+        self._write_meta(model, meta)
+
+        if previous is not None:
+            for name in [*self._array_specs(previous), "deleted"]:
+                self._array_path(model, previous, name).unlink(missing_ok=True)
+        return int(meta["count"])
+
+    @classmethod
+    def _scan(
+        cls,
+        matrix: VectorMatrix,
+        distance_fn: Callable[[slice], np.ndarray],
+        k: int,
+        quality: int | None,
+        max_distance: float | None,
+        after: tuple[float, int] | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        # Block-wise scoring keeps the working set small, only the k best rows of each block are carried over
+        best_rows = np.empty(0, dtype=np.int64)
+        best_distances = np.empty(0, dtype=np.float32)
+        for start in range(0, len(matrix.ids), SEARCH_BLOCK_ROWS):
+            block = slice(start, min(start + SEARCH_BLOCK_ROWS, len(matrix.ids)))
+            distances = distance_fn(block)
+
+            if matrix.live is not None:
+                distances[~matrix.live[block]] = np.inf
+            if quality is not None:
+                distances[matrix.quality[block] != quality] = np.inf
+            if max_distance is not None:
+                distances[distances > max_distance] = np.inf
+            if after is not None:
+                distances[cls._before(distances, matrix.ids[block], after)] = np.inf
+
+            top = np.argpartition(distances, k - 1)[:k] if len(distances) > k else np.arange(len(distances))
+            best_rows = np.concatenate([best_rows, top + start])
+            best_distances = np.concatenate([best_distances, distances[top]])
+            if len(best_distances) > k:
+                keep = np.argpartition(best_distances, k - 1)[:k]
+                best_rows, best_distances = best_rows[keep], best_distances[keep]
+
+        finite = np.isfinite(best_distances)
+        return best_rows[finite], best_distances[finite]
+
+    @staticmethod
+    def _before(distances: np.ndarray, ids: np.ndarray, after: tuple[float, int]) -> np.ndarray:
+        # Rows the previous pages returned, ordered by (distance, id)
+        distance, face_id = after
+        return (distances < distance) | ((distances == distance) & (ids <= face_id))
+
+    @classmethod
+    def _code_distances(
+        cls, matrix: VectorMatrix, unit_query: np.ndarray, query_norm: float, metric: MetricType
+    ) -> Callable[[slice], np.ndarray]:
+        assert matrix.codes is not None
+        codes = matrix.codes
+        query_codes, query_scale = cls._encode(unit_query[None, :], matrix.quantization)
+
+        if matrix.quantization == "binary":
+            # Hamming distance of the sign bits, a coarse candidate order whatever the metric
+            return lambda block: np.bitwise_count(codes[block] ^ query_codes[0]).sum(axis=1, dtype=np.float32)
+
+        def approximate(block: slice) -> np.ndarray:
+            similarity = codes[block].astype(np.float32) @ query_codes[0].astype(np.float32)
+            if matrix.scales is not None and query_scale is not None:
+                similarity *= matrix.scales[block] * query_scale[0]
+            return cls._distances(similarity, matrix.norms[block], query_norm, metric)
+
+        return approximate
+
+    @staticmethod
+    def _distances(similarity: np.ndarray, norms: np.ndarray, query_norm: float, metric: MetricType) -> np.ndarray:
+        if metric == "cosine":
+            return 1.0 - similarity
+        elif metric == "l2":
+            return np.sqrt(np.maximum(norms**2 + query_norm**2 - 2 * norms * query_norm * similarity, 0.0))
+        raise ValueError(f"Metric '{metric}' is not supported.")
+
+    @staticmethod
+    def _encode(unit_vectors: np.ndarray, quantization: QuantizationType) -> tuple[np.ndarray, np.ndarray | None]:
+        if quantization == "halfvec":
+            return unit_vectors.astype(np.float16), None
+        elif quantization == "int8":
+            # Symmetric per-row scale, the largest component of every vector maps to INT8_MAX
+            peaks = np.abs(unit_vectors).max(axis=1)
+            scales = np.where(peaks == 0, 1.0, peaks / INT8_MAX).astype(np.float32)
+            return np.rint(unit_vectors / scales[:, None]).astype(np.int8), scales
+        elif quantization == "binary":
+            return np.packbits(unit_vectors > 0, axis=1), None
+        raise ValueError(f"Quantization '{quantization}' has no codes.")
+
+    @staticmethod
+    def _array_specs(meta: dict[str, Any]) -> dict[str, tuple[type[np.generic], int]]:
+        # Row-aligned arrays of one model, vectors are stored L2-normalized next to their original norms
+        specs: dict[str, tuple[type[np.generic], int]] = {
+            "vectors": (np.float32, meta["dim"]),
+            "norms": (np.float32, 1),
+            "quality": (np.float32, 1),
+            "ids": (np.int64, 1),
+        }
+        quantization = meta.get("quantization", "none")
+        if quantization in CODE_TYPES:
+            specs["codes"] = (
+                CODE_TYPES[quantization],
+                -(-meta["dim"] // 8) if quantization == "binary" else meta["dim"],
+            )
+        if quantization == "int8":
+            specs["scales"] = (np.float32, 1)
+        return specs
+
+    async def _append_rows(self, session: AsyncSession, model: ModelType, meta: dict[str, Any]) -> int:
+        column: InstrumentedAttribute[np.ndarray | None] = getattr(FaceRegion, f"emb_{MODEL_VECTOR_SIZES[model]}")
+        q = (
+            select(FaceRegion.id, column, FaceRegion.face_quality, FaceRegion.emb_norm)
+            .where(FaceRegion.model == model, FaceRegion.id > meta["max_id"], column.is_not(None))
+            .order_by(FaceRegion.id)
+        )
+        specs = self._array_specs(meta)
+
+        added = 0
+        with ExitStack() as stack:
+            files = {}
+            for name, (dtype, width) in specs.items():
+                files[name] = stack.enter_context(open(self._array_path(model, meta, name), "ab"))
+                # Drops the tail of an append that was interrupted before its metadata got written
+                files[name].truncate(meta["count"] * width * np.dtype(dtype).itemsize)
+
+            result = await session.stream(q.execution_options(yield_per=SYNC_BATCH_ROWS))
+            async for rows in result.partitions():
+                vectors = np.stack([np.asarray(row[1], dtype=np.float32) for row in rows])
+                lengths = np.linalg.norm(vectors, axis=1)
+                unit_vectors = vectors / np.where(lengths == 0, 1, lengths)[:, None]
+                # Rows stored normalized carry their original length, older rows are still at full scale
+                norms = np.array(
+                    [row.emb_norm if row.emb_norm is not None else length for row, length in zip(rows, lengths)],
+                    dtype=np.float32,
+                )
+                arrays = {
+                    "vectors": unit_vectors,
+                    "norms": norms,
+                    "quality": np.array([row.face_quality for row in rows], dtype=np.float32),
+                    "ids": np.array([row.id for row in rows], dtype=np.int64),
+                }
+                if "codes" in specs:
+                    arrays["codes"], arrays["scales"] = self._encode(unit_vectors, meta["quantization"])
+
+                for name, (dtype, _) in specs.items():
+                    files[name].write(arrays[name].astype(dtype).tobytes())
+
+                added += len(rows)
+                meta["count"] += len(rows)
+                meta["max_id"] = int(arrays["ids"][-1])
+
+            for file in files.values():
+                file.flush()
+                os.fsync(file.fileno())
+
+        return added
+
+    def _load(self, model: ModelType) -> VectorMatrix:
+        try:
+            st = os.stat(self._meta_path(model))
+        except FileNotFoundError:
+            raise VectorStoreMissing(f"Vector store of {model} is missing, build it with bin.vector_store")
+
+        version = (st.st_ino, st.st_mtime_ns)
+        cached = self._matrices.get(model)
+        if cached is not None and cached.version == version:
+            return cached
+
+        meta = self._read_meta(model)
+        if meta is None:
+            raise VectorStoreMissing(f"Vector store of {model} is missing, build it with bin.vector_store")
+
+        arrays: dict[str, np.ndarray | None] = {"codes": None, "scales": None, "live": None}
+        for name, (dtype, width) in self._array_specs(meta).items():
+            shape = (meta["count"], width) if name in ("vectors", "codes") else (meta["count"],)
+            if meta["count"] == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                # Read-only mapping, the files may already be longer when an append is in progress
+                arrays[name] = np.memmap(self._array_path(model, meta, name), dtype=dtype, mode="r", shape=shape)
+        if meta.get("deleted", 0):
+            deleted = np.fromfile(self._array_path(model, meta, "deleted"), dtype=np.int64, count=meta["deleted"])
+            arrays["live"] = ~np.isin(arrays["ids"], deleted)
+
+        matrix = VectorMatrix(
+            quantization=str_to_quantization_type(meta.get("quantization", "none")), version=version, **arrays
+        )
+        self._matrices[model] = matrix
+        return matrix
+
+    def _read_meta(self, model: ModelType) -> dict[str, Any] | None:
+        try:
+            with open(self._meta_path(model)) as f:
+                return dict(json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def _write_meta(self, model: ModelType, meta: dict[str, Any]) -> None:
+        tmp_path = self._meta_path(model).with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._meta_path(model))
+
+    def _model_dir(self, model: ModelType) -> Path:
+        return self._directory / re.sub(r"[^a-z0-9]+", "_", model.lower())
+
+    def _meta_path(self, model: ModelType) -> Path:
+        return self._model_dir(model) / "meta.json"
+
+    def _array_path(self, model: ModelType, meta: dict[str, Any], name: str) -> Path:
+        return self._model_dir(model) / f"{name}.{meta['generation']}.bin"
@@ -0,0 +1,44 @@
+import asyncio
+
+from sqlalchemy import text
+
+from app.db import engine
+from app.face_region import FaceRegion
+
+"""
+One-off migration adding the random sampling key of /list, it can be interrupted and re-run:
+python -m bin.add_sample_key
+"""
+
+BATCH_ROWS = 10_000
+TABLE = FaceRegion.__tablename__
+
+# No volatile default on ADD COLUMN, it would rewrite the whole table under an exclusive lock
+ADD_COLUMN_SQL = text(f"ALTER TABLE {TABLE} ADD COLUMN IF NOT EXISTS sample_key double precision")
+SET_DEFAULT_SQL = text(f"ALTER TABLE {TABLE} ALTER COLUMN sample_key SET DEFAULT random()")
+ID_RANGE_SQL = text(f"SELECT min(id), max(id) FROM {TABLE} WHERE sample_key IS NULL")
+BACKFILL_SQL = text(f"UPDATE {TABLE} SET sample_key = random() WHERE id >= :start AND id < :end AND sample_key IS NULL")
+CREATE_INDEX_SQL = text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{TABLE}_sample_key ON {TABLE} (sample_key)")
+
+
+async def main():
+    async with engine.begin() as conn:
+        await conn.execute(ADD_COLUMN_SQL)
+        await conn.execute(SET_DEFAULT_SQL)
+        first_id, last_id = (await conn.execute(ID_RANGE_SQL)).one()
+
+    if first_id is not None:
+        for start in range(first_id, last_id + 1, BATCH_ROWS):
+            async with engine.begin() as conn:
+                result = await conn.execute(BACKFILL_SQL, {"start": start, "end": start + BATCH_ROWS})
+            print(f"Backfilled {result.rowcount} rows up to id {min(start + BATCH_ROWS - 1, last_id)}/{last_id}")
+
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(CREATE_INDEX_SQL)
+
+    print("Sample key ready")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
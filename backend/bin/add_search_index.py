@@ -0,0 +1,28 @@
+import asyncio
+
+from sqlalchemy import text
+
+from app.db import engine
+
+"""
+One-off migration adding the trigram index of the /list search to an existing database:
+python -m bin.add_search_index
+"""
+
+CREATE_INDEX_SQL = text(
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_face_region_filename_trgm "
+    "ON face_region USING gin (filename gin_trgm_ops)"
+)
+
+
+async def main():
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        await conn.execute(CREATE_INDEX_SQL)
+
+    print("Search index ready")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,21 @@
+import asyncio
+
+from sqlalchemy import text
+
+from app.db import Base, engine
+from app.face_region import FaceRegion  # noqa: F401
+from app.ingested_image import IngestedImage  # noqa: F401
+from app.user import User  # noqa: F401
+
+
+async def main():
+    # Creates only the missing tables and indexes, existing ones are left untouched
+    async with engine.begin() as conn:
+        # Trigram operator class of the filename search index
+        await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        await conn.run_sync(Base.metadata.create_all)
+    print("Tables created")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
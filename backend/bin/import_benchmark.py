@@ -0,0 +1,50 @@
+import subprocess
+import sys
+
+# The local inference stack is imported on first use only, none of these may be loaded by a plain import
+HEAVY_MODULES = ("tensorflow", "tf_keras", "keras", "deepface", "cv2", "mtcnn", "retinaface")
+ENTRY_MODULES = ("app.container", "app.router", "bin.cli")
+MAX_IMPORT_SECONDS = 2.0
+ROUNDS = 3
+
+PROBE = """
+import sys, time
+started_at = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started_at
+print(elapsed, ",".join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+
+def measure(module: str) -> tuple[float, list[str]]:
+    # Fresh interpreter per round, modules cached by a previous import would hide the cost
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    elapsed, _, loaded = result.stdout.strip().partition(" ")
+    return float(elapsed), [name for name in loaded.split(",") if name]
+
+
+def main(max_seconds: float) -> int:
+    failed = False
+    for module in ENTRY_MODULES:
+        timings: list[float] = []
+        loaded: set[str] = set()
+        for _ in range(ROUNDS):
+            elapsed, heavy = measure(module)
+            timings.append(elapsed)
+            loaded.update(heavy)
+
+        best = min(timings)
+        ok = not loaded and best <= max_seconds
+        failed = failed or not ok
+        print(f"{'OK' if ok else 'FAIL'} {module}: {best:.2f}s, heavy modules: {', '.join(sorted(loaded)) or 'none'}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(float(sys.argv[1]) if len(sys.argv) > 1 else MAX_IMPORT_SECONDS))
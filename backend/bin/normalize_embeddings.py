@@ -0,0 +1,58 @@
+import asyncio
+
+from sqlalchemy import text
+
+from app.db import engine
+from app.face_region import FaceRegion
+
+"""
+One-off migration to L2-normalized embeddings. Run it before the new code serves searches or ingests: the new code
+reads emb_norm and expects unit vectors, distances of rows not migrated yet are wrong.
+It can be interrupted and re-run, rows are migrated in committed batches:
+python -m bin.normalize_embeddings
+python -m bin.vector_index create --model ArcFace --method hnsw
+"""
+
+BATCH_ROWS = 10_000
+TABLE = FaceRegion.__tablename__
+
+ADD_COLUMN_SQL = text(f"ALTER TABLE {TABLE} ADD COLUMN IF NOT EXISTS emb_norm double precision")
+ID_RANGE_SQL = text(f"SELECT min(id), max(id) FROM {TABLE} WHERE emb_norm IS NULL")
+NORMALIZE_SQL = text(
+    f"UPDATE {TABLE} SET "
+    "emb_norm = COALESCE(vector_norm(emb_128), vector_norm(emb_512), vector_norm(emb_4096)), "
+    "emb_128 = l2_normalize(emb_128), emb_512 = l2_normalize(emb_512), emb_4096 = l2_normalize(emb_4096) "
+    "WHERE id >= :start AND id < :end AND emb_norm IS NULL"
+)
+# Searches order by inner product now, L2 searches re-rank the candidates of the inner-product indexes. Cosine and L2
+# indexes are never used again but still slow down every insert
+OBSOLETE_INDEXES_SQL = text(
+    "SELECT DISTINCT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+    "JOIN pg_opclass o ON o.oid = ANY(CAST(i.indclass AS oid[])) "
+    "WHERE i.indrelid = CAST(:table AS regclass) "
+    "AND o.opcname IN ('vector_l2_ops', 'vector_cosine_ops', 'halfvec_l2_ops', 'halfvec_cosine_ops')"
+)
+
+
+async def main():
+    async with engine.begin() as conn:
+        await conn.execute(ADD_COLUMN_SQL)
+        first_id, last_id = (await conn.execute(ID_RANGE_SQL)).one()
+
+    if first_id is not None:
+        for start in range(first_id, last_id + 1, BATCH_ROWS):
+            async with engine.begin() as conn:
+                result = await conn.execute(NORMALIZE_SQL, {"start": start, "end": start + BATCH_ROWS})
+            print(f"Normalized {result.rowcount} rows up to id {min(start + BATCH_ROWS - 1, last_id)}/{last_id}")
+
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        for name in (await conn.execute(OBSOLETE_INDEXES_SQL, {"table": TABLE})).scalars().all():
+            await conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"'))
+            print(f"Dropped obsolete index {name}")
+
+    print("Embeddings normalized, create the inner-product indexes with bin.vector_index")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
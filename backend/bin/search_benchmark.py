@@ -0,0 +1,170 @@
+import argparse
+import asyncio
+import time
+
+import numpy as np
+from sqlalchemy import func, select
+
+from app.app_config import (
+    HNSW_EF_SEARCH,
+    IVFFLAT_PROBES,
+    SEARCH_POOL_SIZE,
+    VECTOR_ITERATIVE_SCAN,
+    VECTOR_QUANTIZATION,
+    VECTOR_RERANK_DEPTH,
+    VECTOR_SEARCH_BACKEND,
+)
+from app.container import container
+from app.db import ReadSession, SearchPool, read_session
+from app.face_region import FaceRegion
+from app.face_repository import FaceRepository
+from app.helpers import MetricType, ModelType, QuantizationType, str_to_metric_type, str_to_model_type
+from app.vector_store import MmapVectorStore
+
+"""
+Stored faces of the model are the queries. Latency of the SQLAlchemy session against the raw asyncpg search pool:
+python -m bin.search_benchmark latency --model ArcFace --metric cosine --queries 200 --limit 100
+Recall@k of the index and quantized searches against an exact scan, of the mmap store with VECTOR_SEARCH_BACKEND=mmap:
+python -m bin.search_benchmark recall --model ArcFace --quantization binary --limit 10
+"""
+
+WARMUP_QUERIES = 5
+
+
+def create_repository(
+    session: ReadSession, search_pool: SearchPool, quantization: QuantizationType = "none"
+) -> FaceRepository:
+    # Quantized and L2 searches always take the SQLAlchemy path
+    return FaceRepository(
+        session,
+        session,
+        ef_search=HNSW_EF_SEARCH,
+        probes=IVFFLAT_PROBES,
+        iterative_scan=VECTOR_ITERATIVE_SCAN,
+        quantization=quantization,
+        rerank_depth=VECTOR_RERANK_DEPTH,
+        search_pool=search_pool,
+    )
+
+
+async def sample_vectors(model: ModelType, count: int) -> list[np.ndarray]:
+    async with read_session() as session:
+        # The random sample_key makes its first rows a uniform sample
+        q = select(FaceRegion.id).where(FaceRegion.model == model).order_by(FaceRegion.sample_key).limit(count)
+        ids = (await session.execute(q)).scalars().all()
+        repository = create_repository(session, SearchPool(0))
+        return [await repository.get_face_vector(face_id) for face_id in ids]
+
+
+async def run(
+    search_pool: SearchPool, vectors: list[np.ndarray], model: ModelType, metric: MetricType, limit: int
+) -> tuple[list[float], list[list[int]]]:
+    timings: list[float] = []
+    results: list[list[int]] = []
+    for i, vector in enumerate(vectors):
+        # A session per search as in a request, the raw path never checks out a session connection
+        async with read_session() as session:
+            started_at = time.perf_counter()
+            faces = await create_repository(session, search_pool).find_similar_faces(vector, model, metric, limit=limit)
+            elapsed = time.perf_counter() - started_at
+        if i >= WARMUP_QUERIES:
+            timings.append(elapsed)
+            results.append([face.face.id for face in faces])
+    return timings, results
+
+
+async def exact_search(vector: np.ndarray, model: ModelType, metric: MetricType, limit: int) -> list[int]:
+    async with read_session() as session:
+        # Without index scans the planner sorts every row by its exact distance
+        await session.execute(select(func.set_config("enable_indexscan", "off", True)))
+        faces = await create_repository(session, SearchPool(0)).find_similar_faces(vector, model, metric, limit=limit)
+    return [face.face.id for face in faces]
+
+
+async def approximate_search(
+    vector: np.ndarray, model: ModelType, metric: MetricType, limit: int, quantization: QuantizationType
+) -> list[int]:
+    if VECTOR_SEARCH_BACKEND == "mmap":
+        store = await container.get(MmapVectorStore)
+        return [face_id for face_id, _ in await asyncio.to_thread(store.search, model, vector, metric, limit)]
+    async with read_session() as session:
+        repository = create_repository(session, SearchPool(0), quantization)
+        faces = await repository.find_similar_faces(vector, model, metric, limit=limit)
+    return [face.face.id for face in faces]
+
+
+async def recall(args: argparse.Namespace, model: ModelType, metric: MetricType, vectors: list[np.ndarray]) -> None:
+    quantization = VECTOR_QUANTIZATION if VECTOR_SEARCH_BACKEND == "mmap" else args.quantization
+    recalls: list[float] = []
+    exact_timings: list[float] = []
+    approximate_timings: list[float] = []
+    for vector in vectors:
+        started_at = time.perf_counter()
+        exact = await exact_search(vector, model, metric, args.limit)
+        exact_timings.append(time.perf_counter() - started_at)
+        started_at = time.perf_counter()
+        approximate = await approximate_search(vector, model, metric, args.limit, quantization)
+        approximate_timings.append(time.perf_counter() - started_at)
+        if exact:
+            recalls.append(len(set(exact) & set(approximate)) / len(exact))
+
+    print(f"{model}, {metric}, {VECTOR_SEARCH_BACKEND} {quantization}, {len(recalls)} searches of {args.limit} faces")
+    report("exact scan", exact_timings)
+    report("search    ", approximate_timings)
+    print(
+        f"recall@{args.limit}: mean {np.mean(recalls):.4f}, p5 {np.percentile(recalls, 5):.4f}, min {min(recalls):.4f}"
+    )
+
+
+def report(name: str, timings: list[float]) -> None:
+    ms = np.array(timings) * 1000
+    print(
+        f"{name}: mean {ms.mean():.2f} ms, p50 {np.percentile(ms, 50):.2f} ms, "
+        f"p95 {np.percentile(ms, 95):.2f} ms, {len(ms) / ms.sum() * 1000:.0f} searches/s"
+    )
+
+
+async def main(args: argparse.Namespace):
+    model = str_to_model_type(args.model)
+    metric = str_to_metric_type(args.metric)
+    vectors = await sample_vectors(model, args.queries + WARMUP_QUERIES)
+    if len(vectors) <= WARMUP_QUERIES:
+        print(f"Not enough {model} faces to benchmark")
+        return
+    if args.command == "recall":
+        await recall(args, model, metric, vectors)
+        return
+
+    if metric != "cosine":
+        print("L2 searches re-rank candidates and have no raw asyncpg path")
+        return
+    search_pool = SearchPool(max(1, SEARCH_POOL_SIZE))
+    if not search_pool.enabled:
+        print("The raw search path needs a postgresql+asyncpg DATABASE_URL")
+        return
+    try:
+        orm_timings, orm_results = await run(SearchPool(0), vectors, model, metric, args.limit)
+        raw_timings, raw_results = await run(search_pool, vectors, model, metric, args.limit)
+    finally:
+        await search_pool.aclose()
+
+    print(f"{model}, {metric}, {len(orm_timings)} searches of {args.limit} faces")
+    report("sqlalchemy", orm_timings)
+    report("asyncpg   ", raw_timings)
+    print(f"p50 speedup {np.percentile(orm_timings, 50) / np.percentile(raw_timings, 50):.2f}x")
+    same = sum(orm == raw for orm, raw in zip(orm_results, raw_results, strict=True))
+    print(f"Identical results for {same}/{len(orm_results)} searches")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Similarity search latency and recall")
+    parser.add_argument("command", choices=["latency", "recall"])
+    parser.add_argument("--model", default="ArcFace")
+    parser.add_argument("--metric", choices=["cosine", "l2"], default="cosine")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--quantization", choices=["none", "halfvec", "binary"], default=None)
+    args = parser.parse_args()
+    # Recall of the configured pgvector search unless given, an int8 default is only valid for the mmap backend
+    args.quantization = args.quantization or ("none" if VECTOR_QUANTIZATION == "int8" else VECTOR_QUANTIZATION)
+    asyncio.run(main(args))
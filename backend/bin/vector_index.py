@@ -0,0 +1,50 @@
+import argparse
+import asyncio
+
+from app.app_config import VECTOR_QUANTIZATION
+from app.container import container
+from app.helpers import str_to_model_type, str_to_quantization_type
+from app.vector_index import VectorIndexManager
+
+"""
+python -m bin.vector_index list
+python -m bin.vector_index create --model ArcFace --method hnsw
+python -m bin.vector_index rebuild --model ArcFace --method ivfflat --lists 2000
+python -m bin.vector_index drop --model ArcFace --method hnsw
+python -m bin.vector_index create --model VGG-Face --method hnsw --quantization binary
+"""
+
+INDEX_QUANTIZATIONS = ["none", "halfvec", "binary"]
+
+
+async def main(args: argparse.Namespace):
+    manager = await container.get(VectorIndexManager)
+
+    if args.command == "list":
+        for info in await manager.list_indexes():
+            state = "valid" if info.valid else "INVALID"
+            print(f"{info.name} ({info.method}, {state}, {info.size_bytes / 1024 / 1024:.1f} MB): {info.definition}")
+        return
+
+    model = str_to_model_type(args.model)
+    quantization = str_to_quantization_type(args.quantization)
+    if args.command == "drop":
+        print(f"Dropped {await manager.drop_index(model, args.method, quantization)}")
+    else:
+        await manager.create_index(
+            model, args.method, quantization, rebuild=args.command == "rebuild", lists=args.lists
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vector index management for face embeddings")
+    parser.add_argument("command", choices=["list", "create", "rebuild", "drop"])
+    parser.add_argument("--model", default="ArcFace")
+    parser.add_argument("--method", choices=["hnsw", "ivfflat"], default="hnsw")
+    parser.add_argument("--quantization", choices=INDEX_QUANTIZATIONS, default=VECTOR_QUANTIZATION)
+    parser.add_argument("--lists", type=int, default=None, help="IVFFlat lists, derived from the row count by default")
+    args = parser.parse_args()
+    # argparse checks the choices of given values only, the default comes from VECTOR_QUANTIZATION
+    if args.quantization not in INDEX_QUANTIZATIONS:
+        parser.error(f"pgvector cannot index {args.quantization} codes, use one of {', '.join(INDEX_QUANTIZATIONS)}")
+    asyncio.run(main(args))
@@ -0,0 +1,31 @@
+import argparse
+import asyncio
+
+from app.container import container
+from app.db import async_session_factory
+from app.helpers import str_to_model_type
+from app.vector_store import MmapVectorStore
+
+"""
+python -m bin.vector_store rebuild --model ArcFace
+python -m bin.vector_store sync --model ArcFace
+The feeder drops the rows it replaces from the store, faces deleted from the table otherwise need a rebuild
+"""
+
+
+async def main(args: argparse.Namespace):
+    store = await container.get(MmapVectorStore)
+    model = str_to_model_type(args.model)
+
+    async with async_session_factory() as session:
+        if args.command == "rebuild":
+            print(f"{model}: {await store.rebuild(session, model)} vectors written")
+        else:
+            print(f"{model}: {await store.sync(session, model)} vectors appended")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory-mapped vector store for VECTOR_SEARCH_BACKEND=mmap")
+    parser.add_argument("command", choices=["rebuild", "sync"])
+    parser.add_argument("--model", default="ArcFace")
+    asyncio.run(main(parser.parse_args()))